@@ -0,0 +1,1377 @@
+"""离线压测与基准测试：用假的 Bot/Update 直接驱动 truth_dare_bot 中真实的处理函数
+
+不连接 Telegram。FakeBot 记录所有发出的请求，并按配置注入网络延迟；更新经由 bot 实际使用的
+ChatOrderedUpdateProcessor 并发分发，和线上的处理方式一致。
+
+场景:
+    workload  N 个群组、每组 M 名玩家，按比例混合 join/roll/leave/kick/stop，统计吞吐量、
+              各命令处理延迟分位数、游戏锁等待时间、消息发送完成时间
+    timers    N 个闲置游戏依次触发 10/20 分钟提醒和 30 分钟超时，统计 game_timer_check/
+              timer_task_processor 的处理速度
+    ordering  多群组交错的命令并发处理后，与顺序重放的结果逐一比较，并检查并发数没有超过上限
+    memory    tracemalloc 统计每个游戏占用的内存
+    restore   SQLite 存储批量写入与热重启恢复耗时；一次写入失败（数据库被锁）后修改和删除是否仍能写入
+    render    超大游戏（默认 1 万人）掷骰结果的生成与分段耗时，完整列表和精简模式各测一次
+    flood     少量群组正常游戏的同时，一个群组被多个账号刷命令，对比开启/关闭限流时的回复数和限流检查开销；
+              另测大量账号各发一次命令触发群组限额时的提示条数
+    eventlog  事件日志存储：真实命令产生的事件写入（其间一次写入失败后重试）与重放结果一致性，批量写入吞吐量、磁盘占用、
+              快照压缩耗时，以及全量重放与“快照 + 尾部”重放的耗时
+    stats     战绩统计：历史增长到百万次掷骰时 /top、/mystats 的查询延迟和每次掷骰的统计开销；
+              大量群组下按容量换出到 SQLite 后的内存占用、重新读入的耗时与数据一致性
+    lifecycle 受监管的后台任务：发送器第一次启动即崩溃后自动重启；退出时在真实限速下处理完已入队的
+              定时任务、发完待发消息，统计耗时、丢失数和实际发送速率
+    lobby     大厅消息模式：同样的游戏流程（创建、一批玩家集中加入、多次掷骰、有人离开、结束，
+              以及闲置到计时提醒和超时结束）在关闭/开启 LOBBY_MODE 时每个游戏的 Bot API 调用数；
+              另测大厅消息被删除后陆续有人加入时补发的消息数，以及延迟编辑到期前游戏被换出时不会被读回
+    soak      长时间运行：虚拟时钟每轮前进 5 分钟，每轮新来一批群组开局后部分结束、其余闲置，
+              记录各轮内存中的游戏、锁、冷却记录、发送状态和 tracemalloc 内存；关闭/开启闲置游戏换出各跑一次，
+              比较内存占用、读回换出游戏的延迟和最终状态是否一致
+
+用法:
+    python bench/benchmark.py --groups 200 --players 8 --output result.json
+    python bench/benchmark.py --compare old.json new.json
+
+任何场景的一致性检查（*consistent、within_limit）不通过时以非零状态退出，
+例如 python bench/benchmark.py --scenarios ordering 可以单独用来检查同一群组的更新是否按顺序处理。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:offline-benchmark")
+
+import truth_dare_bot as bot_module  # noqa: E402
+from telegram import Chat, Message, Update, User  # noqa: E402
+from telegram.error import BadRequest  # noqa: E402
+from telegram.ext import ApplicationHandlerStop  # noqa: E402
+
+
+class FakeBot:
+    """记录所有 Bot API 调用，每次调用等待 latency±jitter 秒模拟网络往返"""
+
+    username = "fake_tod_bot"
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.sent = 0
+        self.edited = 0
+        self.sent_by_chat = Counter()
+        self.next_message_id = 1
+        self.deleted = set()  # 被“删除”的消息 ID，编辑它们时像 Telegram 一样返回 BadRequest
+        self.delivered = asyncio.Event()
+        self.expected = None
+
+    async def _network(self, method) -> None:
+        self.calls[method] += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _message(self, chat_id, text):
+        self.next_message_id += 1
+        return SimpleNamespace(message_id=self.next_message_id, chat_id=chat_id, text=text)
+
+    @property
+    def completed(self) -> int:
+        """已完成的发送和编辑次数"""
+        return self.sent + self.edited
+
+    def _check_delivered(self) -> None:
+        if self.expected is not None and self.completed >= self.expected:
+            self.delivered.set()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._network("sendMessage")
+        self.sent += 1
+        self.sent_by_chat[chat_id] += 1
+        self._check_delivered()
+        return self._message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._network("editMessageText")
+        if message_id in self.deleted:
+            raise BadRequest("Message to edit not found")
+        self.edited += 1
+        self._check_delivered()
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    async def get_chat_administrators(self, chat_id):
+        await self._network("getChatAdministrators")
+        return []
+
+
+class UpdateFactory:
+    """构造真实的 telegram.Update 对象（不绑定 Bot，不访问网络）"""
+
+    def __init__(self):
+        self.update_id = 0
+        self.users = {}
+        self.chats = {}
+
+    def user(self, user_id) -> User:
+        user = self.users.get(user_id)
+        if user is None:
+            # 大约一半玩家没有用户名，覆盖 join 时的额外提醒
+            username = f"player{user_id}" if user_id % 2 else None
+            user = self.users[user_id] = User(user_id, f"玩家{user_id}", False, username=username)
+        return user
+
+    def chat(self, chat_id) -> Chat:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = Chat(chat_id, Chat.SUPERGROUP)
+        return chat
+
+    def command(self, chat_id, user_id, text, reply_to_user=None) -> Update:
+        self.update_id += 1
+        reply_to = None
+        if reply_to_user is not None:
+            reply_to = Message(self.update_id, datetime.datetime.now(), self.chat(chat_id),
+                               from_user=self.user(reply_to_user), text="hi")
+        message = Message(
+            self.update_id, datetime.datetime.now(), self.chat(chat_id),
+            from_user=self.user(user_id), text=text, reply_to_message=reply_to
+        )
+        return Update(self.update_id, message=message)
+
+
+HANDLERS = {
+    "/createnewgame": "create_game",
+    "/join": "join_game",
+    "/leave": "leave_game",
+    "/roll": "roll_dice",
+    "/stop": "stop_game",
+    "/adminstop": "admin_stop",
+    "/help": "help_command",
+    "/top": "top_command",
+    "/mystats": "mystats_command",
+}
+
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "p50_ms": round(pick(0.50) * 1000, 4),
+        "p95_ms": round(pick(0.95) * 1000, 4),
+        "p99_ms": round(pick(0.99) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+
+class Harness:
+    """重置 bot 的模块级状态、启动后台任务并记录处理延迟与锁等待"""
+
+    def __init__(self, fake_bot, real_limits=False, roll_cooldown=0, flood_guard=False):
+        self.bot = fake_bot
+        self.context = SimpleNamespace(bot=fake_bot)
+        self.latencies = defaultdict(list)
+        self.lock_waits = []
+        self.guard_times = []
+        self.enqueued = 0
+        self.enqueued_by_chat = Counter()
+        self.throttled = Counter()
+        self.flood_guard = flood_guard
+        self.tasks = []
+        self._reset_state(real_limits, roll_cooldown)
+
+    def _reset_state(self, real_limits, roll_cooldown) -> None:
+        b = bot_module
+        b.games.clear()
+        b.game_locks.clear()
+        b.timer_heap.clear()
+        b._stale_timers = 0
+        b.chat_send_states.clear()
+        # asyncio 队列和事件会绑定首次使用时的事件循环，每次运行重新创建
+        b.message_queue = asyncio.PriorityQueue()
+        b.timer_queue = asyncio.Queue()
+        b.timer_wakeup = asyncio.Event()
+        b.admin_cache = b.AdminCache(b.ADMIN_CACHE_TTL, b.ADMIN_CACHE_SIZE)
+        b.game_store = b.MemoryGameStore()
+        b.stats_store = b.StatsStore(None, b.STATS_CACHE_SIZE)
+        b.spill_store = None
+        b.lobbies.clear()
+        b.command_limiter = b.RateLimiter(b.RATE_LIMIT_MAX_BUCKETS)
+        b.flood_notices = b.RateLimiter(b.RATE_LIMIT_MAX_BUCKETS)
+        b.roll_cooldowns = b.RateLimiter(b.RATE_LIMIT_MAX_BUCKETS)
+        b.ROLL_COOLDOWN = roll_cooldown
+        if not real_limits:
+            # 默认不受 Telegram 发送速率限制，只测 bot 自身的处理能力
+            b.MAX_MESSAGES_PER_SECOND = 10 ** 6
+            b.MAX_MESSAGES_PER_CHAT_PER_MINUTE = 10 ** 6
+            b.CHAT_BURST = 10 ** 6
+            b.MAX_CONCURRENT_SENDS = 256
+
+        original_lock = _ORIGINAL["game_lock"]
+        original_enqueue = _ORIGINAL["enqueue_message"]
+        harness = self
+
+        @asynccontextmanager
+        async def timed_game_lock(chat_id, thread_id):
+            started = time.perf_counter()
+            async with original_lock(chat_id, thread_id):
+                harness.lock_waits.append(time.perf_counter() - started)
+                yield
+
+        def counted_enqueue(chat_id, *args, **kwargs):
+            harness.enqueued += 1
+            harness.enqueued_by_chat[chat_id] += 1
+            return original_enqueue(chat_id, *args, **kwargs)
+
+        b.game_lock = timed_game_lock
+        b.enqueue_message = counted_enqueue
+
+    def start_background(self, timers=False) -> None:
+        b = bot_module
+        self.tasks.append(asyncio.create_task(b.message_queue_sender(self.context)))
+        self.tasks.append(asyncio.create_task(b.timer_task_processor()))
+        if timers:
+            self.tasks.append(asyncio.create_task(b.game_timer_scheduler(self.context)))
+
+    async def stop_background(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def handle(self, update) -> None:
+        command = update.message.text.split()[0]
+        handler = getattr(bot_module, HANDLERS[command])
+        if self.flood_guard:
+            # 和 Application 中 group -1 的前置处理器一样，抛出 ApplicationHandlerStop 表示丢弃
+            started = time.perf_counter()
+            try:
+                await bot_module.flood_guard(update, self.context)
+            except ApplicationHandlerStop:
+                self.throttled[update.effective_chat.id] += 1
+                return
+            finally:
+                self.guard_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await handler(update, self.context)
+        self.latencies[command].append(time.perf_counter() - started)
+
+    async def dispatch(self, updates, concurrency) -> float:
+        """像 Application 一样为每个更新创建任务，经由 ChatOrderedUpdateProcessor 处理"""
+        processor = bot_module.ChatOrderedUpdateProcessor(concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*[processor.process_update(u, self.handle(u)) for u in updates])
+        return time.perf_counter() - started
+
+    async def wait_delivered(self, timeout) -> float:
+        """等待所有入队的消息被 FakeBot 收到，返回等待时间"""
+        started = time.perf_counter()
+        self.bot.expected = self.enqueued
+        if self.bot.completed < self.enqueued:
+            self.bot.delivered.clear()
+            try:
+                await asyncio.wait_for(self.bot.delivered.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return time.perf_counter() - started
+
+
+_ORIGINAL = {
+    "game_lock": bot_module.game_lock,
+    "enqueue_message": bot_module.enqueue_message,
+    "message_queue_sender": bot_module.message_queue_sender,
+    "limits": (
+        bot_module.MAX_MESSAGES_PER_SECOND,
+        bot_module.MAX_MESSAGES_PER_CHAT_PER_MINUTE,
+        bot_module.CHAT_BURST,
+        bot_module.MAX_CONCURRENT_SENDS,
+    ),
+}
+
+
+def build_workload(groups, players, ops, seed, factory) -> list:
+    """生成按群组交错排列的命令序列：每组创建游戏、玩家加入、若干随机操作、最后结束"""
+    rng = random.Random(seed)
+    per_group = []
+    for g in range(groups):
+        chat_id = -1001000000000 - g
+        host = 10_000_000 + g
+        pool = [100_000 * (g + 1) + p for p in range(players * 2)]
+        joined = pool[:players]
+        waiting = pool[players:]
+        commands = [factory.command(chat_id, host, "/createnewgame")]
+        commands += [factory.command(chat_id, user_id, "/join") for user_id in joined]
+        for _ in range(ops):
+            op = rng.choices(("roll", "join", "leave", "kick", "help"), weights=(5, 2, 2, 1, 1))[0]
+            if op == "roll":
+                commands.append(factory.command(chat_id, host, "/roll"))
+            elif op == "join" and waiting:
+                user_id = waiting.pop()
+                joined.append(user_id)
+                commands.append(factory.command(chat_id, user_id, "/join"))
+            elif op == "leave" and len(joined) > 2:
+                user_id = joined.pop(rng.randrange(len(joined)))
+                waiting.append(user_id)
+                commands.append(factory.command(chat_id, user_id, "/leave"))
+            elif op == "kick" and len(joined) > 2:
+                user_id = joined.pop(rng.randrange(len(joined)))
+                waiting.append(user_id)
+                commands.append(factory.command(chat_id, host, "/leave", reply_to_user=user_id))
+            else:
+                commands.append(factory.command(chat_id, host, "/help"))
+        commands.append(factory.command(chat_id, host, "/stop"))
+        per_group.append(commands)
+
+    # 轮流从各群组取命令，模拟多个群组同时活跃
+    interleaved = []
+    for i in range(max(len(c) for c in per_group)):
+        for commands in per_group:
+            if i < len(commands):
+                interleaved.append(commands[i])
+    return interleaved
+
+
+async def scenario_workload(args) -> dict:
+    factory = UpdateFactory()
+    updates = build_workload(args.groups, args.players, args.ops, args.seed, factory)
+    fake_bot = FakeBot(args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+    harness = Harness(fake_bot, real_limits=args.real_limits)
+    harness.start_background()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    elapsed = await harness.dispatch(updates, args.concurrency)
+    drain = await harness.wait_delivered(args.drain_timeout)
+    memory = None
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = {"current_bytes": current, "peak_bytes": peak}
+    await harness.stop_background()
+
+    all_latencies = [x for samples in harness.latencies.values() for x in samples]
+    return {
+        "updates": len(updates),
+        "handled_seconds": round(elapsed, 4),
+        "throughput_updates_per_s": round(len(updates) / elapsed, 1),
+        "handler_latency": percentiles(all_latencies),
+        "handler_latency_by_command": {c: percentiles(s) for c, s in sorted(harness.latencies.items())},
+        "lock_wait": percentiles(harness.lock_waits),
+        "messages_enqueued": harness.enqueued,
+        "messages_sent": fake_bot.sent,
+        "api_calls": dict(fake_bot.calls),
+        "send_drain_seconds": round(drain, 4),
+        "send_throughput_msgs_per_s": round(fake_bot.sent / (elapsed + drain), 1),
+        "tracemalloc": memory,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+async def scenario_timers(args) -> dict:
+    """闲置游戏：把主持人最后操作时间拨回 31 分钟，依次触发两次提醒和超时结束"""
+    factory = UpdateFactory()
+    fake_bot = FakeBot(args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+    harness = Harness(fake_bot, real_limits=args.real_limits)
+    b = bot_module
+
+    for g in range(args.idle_games):
+        await harness.handle(factory.command(-1002000000000 - g, 20_000_000 + g, "/createnewgame"))
+    past = time.time() - b.GAME_TIMEOUT - 60
+    for (chat_id, thread_id), game in b.games.items():
+        game.host_last_active = past
+        b._schedule_game_timer(chat_id, thread_id, game)
+
+    harness.start_background(timers=True)
+    started = time.perf_counter()
+    while b.games and time.perf_counter() - started < args.drain_timeout:
+        await asyncio.sleep(0.01)
+    fired = time.perf_counter() - started
+    drain = await harness.wait_delivered(args.drain_timeout)
+    await harness.stop_background()
+
+    return {
+        "idle_games": args.idle_games,
+        "games_left": len(b.games),
+        "timer_actions": harness.enqueued - args.idle_games,  # 减去创建游戏时的回复
+        "timer_seconds": round(fired, 4),
+        "timer_actions_per_s": round((harness.enqueued - args.idle_games) / fired, 1) if fired else None,
+        "lock_wait": percentiles(harness.lock_waits),
+        "send_drain_seconds": round(drain, 4),
+        "messages_sent": fake_bot.sent,
+    }
+
+
+async def scenario_ordering(args) -> dict:
+    """并发处理（注入随机延迟）与顺序重放得到的游戏状态必须完全一致"""
+    factory = UpdateFactory()
+    rng = random.Random(args.seed)
+    commands = ("/createnewgame", "/join", "/leave", "/stop", "/roll")
+    updates = [
+        factory.command(-rng.randint(1, args.groups), rng.randint(1, 12),
+                        rng.choices(commands, weights=(1, 8, 3, 1, 2))[0])
+        for _ in range(args.groups * 100)
+    ]
+
+    def snapshot():
+        return {key: (game.host_id, sorted(game.participants)) for key, game in bot_module.games.items()}
+
+    harness = Harness(FakeBot())
+    for update in updates:
+        await harness.handle(update)
+    sequential = snapshot()
+
+    harness = Harness(FakeBot())
+    jitter = random.Random(args.seed + 1)
+    in_flight = peak = 0
+
+    async def handle_with_jitter(update):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(jitter.random() * 0.002)
+            await harness.handle(update)
+            await asyncio.sleep(jitter.random() * 0.002)
+        finally:
+            in_flight -= 1
+
+    processor = bot_module.ChatOrderedUpdateProcessor(args.concurrency)
+    await asyncio.gather(*[processor.process_update(u, handle_with_jitter(u)) for u in updates])
+    concurrent = snapshot()
+    return {
+        "updates": len(updates),
+        "games": len(sequential),
+        "peak_concurrency": peak,
+        "within_limit": 1 < peak <= args.concurrency,
+        "consistent": sequential == concurrent,
+    }
+
+
+def failed_checks(result, path="") -> list:
+    """结果中所有为 False 的正确性检查项（*consistent、within_limit），返回它们的路径"""
+    failed = []
+    for key, value in result.items():
+        if isinstance(value, dict):
+            failed += failed_checks(value, f"{path}{key}.")
+        elif value is False and (key.endswith("consistent") or key == "within_limit"):
+            failed.append(path + key)
+    return failed
+
+
+async def scenario_memory(args) -> dict:
+    factory = UpdateFactory()
+    updates = []
+    for g in range(args.memory_games):
+        chat_id = -1003000000000 - g
+        updates.append(factory.command(chat_id, 30_000_000 + g, "/createnewgame"))
+        updates += [factory.command(chat_id, 1_000_000 * (g + 1) + p, "/join") for p in range(args.players)]
+    harness = Harness(FakeBot())
+    # 回复只入队不发送，先清掉避免计入游戏占用的内存
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for update in updates:
+        await harness.handle(update)
+    bot_module.message_queue = asyncio.PriorityQueue()
+    current = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return {
+        "games": args.memory_games,
+        "players_per_game": args.players,
+        "state_bytes": current,
+        "bytes_per_game": round(current / args.memory_games),
+    }
+
+
+async def _flush_after_failure(store, method, error) -> None:
+    """让 store 的写入方法 method 第一次调用时抛出 error，然后再 flush 一次"""
+    original = getattr(store, method)
+
+    def failing(*a, **kw):
+        setattr(store, method, original)
+        raise error
+
+    setattr(store, method, failing)
+    try:
+        await store.flush()
+    except type(error):
+        pass
+    await store.flush()
+
+
+async def _restore_after_failed_flush(b, tmp) -> bool:
+    """一次写入失败后，之前的修改和删除在下一次 flush 时仍然写入磁盘"""
+    path = os.path.join(tmp, "locked.db")
+    store = b.SQLiteGameStore(path)
+    now = time.time()
+    live = {}
+    for g in range(100):
+        chat_id = -1004500000000 - g
+        live[chat_id] = b.Game(chat_id, g, f"主持人{g}", now)
+        store.save_game(chat_id, None, live[chat_id])
+    await store.flush()
+    for g in range(50):
+        chat_id = -1004500000000 - g
+        if g % 2:
+            store.delete_game(chat_id, None)
+            del live[chat_id]
+        else:
+            live[chat_id].add_participant(1, "玩家1", None, 101)
+            store.save_game(chat_id, None, live[chat_id])
+    await _flush_after_failure(store, "_write", sqlite3.OperationalError("database is locked"))
+    store.close()
+    store = b.SQLiteGameStore(path)
+    loaded = {chat_id: sorted(game.participants) for chat_id, _, game in store.load_games()}
+    store.close()
+    return loaded == {chat_id: sorted(game.participants) for chat_id, game in live.items()}
+
+
+async def scenario_restore(args) -> dict:
+    b = bot_module
+    Harness(FakeBot())
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "games.db")
+        b.game_store = b.SQLiteGameStore(path)
+        now = time.time()
+        for g in range(args.restore_games):
+            chat_id = -1004000000000 - g
+            game = b.games[(chat_id, None)] = b.Game(chat_id, g, f"主持人{g}", now)
+            for p in range(args.players):
+                game.add_participant(p, f"玩家{p}", None, 100 + p)
+            b.game_store.save_game(chat_id, None, game)
+        started = time.perf_counter()
+        await b.game_store.flush()
+        flush = time.perf_counter() - started
+        b.game_store.close()
+
+        b.games.clear()
+        b.timer_heap.clear()
+        started = time.perf_counter()
+        b.game_store = b.SQLiteGameStore(path)
+        restored = b.restore_games()
+        restore = time.perf_counter() - started
+        b.game_store.close()
+        failed_flush_consistent = await _restore_after_failed_flush(b, tmp)
+    return {
+        "games": args.restore_games,
+        "restored": restored,
+        "flush_seconds": round(flush, 4),
+        "restore_seconds": round(restore, 4),
+        "failed_flush_consistent": failed_flush_consistent,
+    }
+
+
+async def scenario_render(args) -> dict:
+    b = bot_module
+    Harness(FakeBot())
+    rng = random.Random(args.seed)
+    chat_id = -1005000000000
+    host = SimpleNamespace(id=1)
+    game = b.games[(chat_id, None)] = b.Game(chat_id, host.id, "主持人", time.time())
+    for p in range(args.render_players):
+        name = rng.choice((f"玩家{p}", f"Player {p} 🎉", "A&B <c>", "很长的名字" * 6))
+        game.add_participant(10 + p, name, f"user{p}" if p % 2 else None, 100 + p)
+
+    def measure(compact_threshold) -> dict:
+        b.ROLL_COMPACT_THRESHOLD = compact_threshold
+        durations, chunk_counts, longest = [], [], 0
+        for _ in range(args.render_rounds):
+            started = time.perf_counter()
+            texts, _ = b._roll_dice_locked(chat_id, None, host, time.time())
+            durations.append(time.perf_counter() - started)
+            chunk_counts.append(len(texts))
+            longest = max(longest, max(b._visible_length(text) for text in texts))
+        return {
+            "render": percentiles(durations),
+            "chunks": max(chunk_counts),
+            "longest_chunk": longest,
+        }
+
+    original = b.ROLL_COMPACT_THRESHOLD
+    try:
+        full = measure(0)
+        compact = measure(1)
+    finally:
+        b.ROLL_COMPACT_THRESHOLD = original
+    return {"players": args.render_players, "full": full, "compact": compact}
+
+
+async def scenario_flood(args) -> dict:
+    """正常游戏的群组混入一个被 flood_spammers 个账号刷屏的群组"""
+    factory = UpdateFactory()
+    spam_chat = -1006000000000
+    rng = random.Random(args.seed)
+    # 正常群组每个操作之间不等待，操作数压低到真实节奏下不会触发限流的程度
+    normal = build_workload(args.flood_groups, args.players, 8, args.seed, factory)
+    spam = [
+        factory.command(spam_chat, 60_000_000 + rng.randrange(args.flood_spammers), rng.choice(("/join", "/leave", "/help")))
+        for _ in range(args.flood_spam)
+    ]
+    # 刷屏命令均匀插入正常命令之间
+    updates = []
+    step = max(1, len(spam) // max(1, len(normal)))
+    for i, update in enumerate(normal):
+        updates.append(update)
+        updates += spam[i * step:(i + 1) * step]
+    updates += spam[len(normal) * step:]
+
+    results = {"updates": len(updates), "spam_updates": len(spam)}
+    for label, guard in (("unguarded", False), ("guarded", True)):
+        harness = Harness(FakeBot(), flood_guard=guard)
+        handled = await harness.dispatch(updates, args.concurrency)
+        spam_throttled = harness.throttled.pop(spam_chat, 0)
+        results[label] = {
+            "throughput_updates_per_s": round(len(updates) / handled, 1),
+            "spam_replies": harness.enqueued_by_chat[spam_chat],
+            "spam_throttled": spam_throttled,
+            "normal_throttled": sum(harness.throttled.values()),
+            "normal_replies": harness.enqueued - harness.enqueued_by_chat[spam_chat],
+            "guard": percentiles(harness.guard_times),
+            "limiter_buckets": len(bot_module.command_limiter.buckets),
+        }
+
+    # 很多账号各发一次命令，只触发群组限额：整个群组只应收到一条限流提示
+    harness = Harness(FakeBot(), flood_guard=True)
+    crowd = [factory.command(spam_chat, 61_000_000 + i, "/help") for i in range(args.flood_crowd)]
+    await harness.dispatch(crowd, args.concurrency)
+    throttled = harness.throttled[spam_chat]
+    results["crowd"] = {
+        "accounts": args.flood_crowd,
+        "throttled": throttled,
+        "replies": harness.enqueued,
+        "notices": harness.enqueued - (args.flood_crowd - throttled),
+    }
+    return results
+
+
+def _game_state(games) -> dict:
+    return {
+        key: (game.host_id, game.timer_state, game.last_roll_time, game.host_last_active,
+              [(user_id, p.full_name, p.username, p.message_id) for user_id, p in game.participants.items()])
+        for key, game in games.items()
+    }
+
+
+def _dir_bytes(path) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+async def scenario_eventlog(args) -> dict:
+    b = bot_module
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # 1. 真实命令：一半群组最后不结束游戏，其间有一次写入失败，重启后重放出的状态必须与内存中完全一致
+        factory = UpdateFactory()
+        updates = [
+            u for u in build_workload(args.groups, args.players, args.ops, args.seed, factory)
+            if not (u.message.text == "/stop" and u.effective_chat.id % 2 == 0)
+        ]
+        harness = Harness(FakeBot())
+        path = os.path.join(tmp, "workload")
+        b.game_store = b.EventLogGameStore(path)
+        half = len(updates) // 2
+        elapsed = await harness.dispatch(updates[:half], args.concurrency)
+        events = len(b.game_store._pending)
+        await b.game_store.flush()
+        # 后一半命令的事件第一次写入失败（如磁盘已满），下一次 flush 重试
+        elapsed += await harness.dispatch(updates[half:], args.concurrency)
+        events += len(b.game_store._pending)
+        await _flush_after_failure(b.game_store, "_append", OSError("No space left on device"))
+        live = _game_state(b.games)
+        written = _dir_bytes(path)
+        b.game_store._closed = True  # 模拟进程崩溃：不做退出快照
+        b.game_store._close_segment()
+        replayed = {
+            (chat_id, thread_id): game
+            for chat_id, thread_id, game in b.EventLogGameStore(path).load_games()
+        }
+        results["workload"] = {
+            "updates": len(updates),
+            "throughput_updates_per_s": round(len(updates) / elapsed, 1),
+            "events": events,
+            "bytes": written,
+            "bytes_per_event": round(written / events, 1) if events else None,
+            "games": len(live),
+            "replay_consistent": _game_state(replayed) == live,
+        }
+
+        # 2. 合成事件流：按 0.5 秒一批的节奏写入，测吞吐量和磁盘增长
+        Harness(FakeBot())
+        path = os.path.join(tmp, "synthetic")
+        store = b.game_store = b.EventLogGameStore(path)
+        rng = random.Random(args.seed)
+        chats = max(1, args.eventlog_events // 200)
+        now = time.time()
+        for c in range(chats):
+            store.record_event("create", -1007000000000 - c, None, now, c, f"主持人{c}")
+        record_time = write_time = 0.0
+        batch = 5000
+        for start in range(0, args.eventlog_events, batch):
+            # 先生成整批事件参数，计时只包含 record_event 本身
+            pending = []
+            for i in range(start, min(start + batch, args.eventlog_events)):
+                chat_id = -1007000000000 - rng.randrange(chats)
+                kind = rng.choices(("join", "leave", "touch", "roll", "timer"), weights=(4, 2, 2, 2, 1))[0]
+                user_id = rng.randrange(50)
+                if kind == "join":
+                    pending.append((kind, chat_id, None, now, user_id, f"玩家{user_id}", f"user{user_id}", 100 + i))
+                elif kind == "leave":
+                    pending.append((kind, chat_id, None, now, user_id))
+                elif kind == "roll":
+                    rolls = tuple((p, rng.randint(1, 100)) for p in range(8))
+                    pending.append((kind, chat_id, None, now, user_id, user_id + 1, rolls))
+                elif kind == "timer":
+                    pending.append((kind, chat_id, None, now, 10))
+                else:
+                    pending.append((kind, chat_id, None, now))
+            started = time.perf_counter()
+            for event in pending:
+                store.record_event(*event)
+            record_time += time.perf_counter() - started
+            store._events_since_snapshot = 0  # 只测追加写入，快照单独测
+            started = time.perf_counter()
+            await store.flush()
+            write_time += time.perf_counter() - started
+        total = args.eventlog_events + chats
+        log_bytes = _dir_bytes(path)
+
+        started = time.perf_counter()
+        restored = b.EventLogGameStore(path).load_games()
+        full_replay = time.perf_counter() - started
+
+        # 3. 快照：把重放出的游戏放回内存后强制做一次快照，旧分段随之删除
+        for chat_id, thread_id, game in restored:
+            b.games[(chat_id, thread_id)] = game
+        store._events_since_snapshot = b.EVENT_LOG_SNAPSHOT_EVENTS
+        started = time.perf_counter()
+        await store.flush()
+        snapshot = time.perf_counter() - started
+        compacted_bytes = _dir_bytes(path)
+
+        # 4. 快照之后再写入少量事件，重放只需要读尾部
+        tail = min(batch, args.eventlog_events)
+        for i in range(tail):
+            store.record_event("touch", -1007000000000 - rng.randrange(chats), None, now)
+        await store.flush()
+        store._closed = True
+        store._close_segment()
+        started = time.perf_counter()
+        tail_restored = b.EventLogGameStore(path).load_games()
+        tail_replay = time.perf_counter() - started
+
+        results["synthetic"] = {
+            "events": total,
+            "record_us_per_event": round(record_time / total * 1e6, 3),
+            "write_events_per_s": round(total / write_time, 1),
+            "log_bytes": log_bytes,
+            "bytes_per_event": round(log_bytes / total, 1),
+            "full_replay_seconds": round(full_replay, 4),
+            "full_replay_events_per_s": round(total / full_replay, 1),
+            "games": len(restored),
+            "snapshot_seconds": round(snapshot, 4),
+            "bytes_after_compaction": compacted_bytes,
+            "tail_events": tail,
+            "snapshot_tail_replay_seconds": round(tail_replay, 4),
+            "snapshot_tail_games": len(tail_restored),
+        }
+    b.game_store = b.MemoryGameStore()
+    return results
+
+
+async def scenario_stats(args) -> dict:
+    b = bot_module
+    factory = UpdateFactory()
+    harness = Harness(FakeBot())
+    rng = random.Random(args.seed)
+    chat_id = -1008000000000
+    pool = list(range(1, args.stats_players + 1))
+
+    async def query_latency(samples=200) -> dict:
+        durations = {"/top": [], "/mystats": []}
+        for i in range(samples):
+            for command in durations:
+                update = factory.command(chat_id, pool[i % len(pool)], command)
+                started = time.perf_counter()
+                await harness.handle(update)
+                durations[command].append(time.perf_counter() - started)
+        b.message_queue = asyncio.PriorityQueue()
+        return {command: percentiles(values) for command, values in durations.items()}
+
+    # 1. 单个群组的历史逐步增长：每 20 次掷骰换一局，每局随机 players 名玩家
+    checkpoints = sorted({n for n in (1000, 10000, 100000, args.stats_rolls) if n <= args.stats_rolls})
+    growth, record_time, done, game = [], 0.0, 0, None
+    for checkpoint in checkpoints:
+        while done < checkpoint:
+            if done % 20 == 0:
+                game = b.Game(chat_id, 0, "主持人", time.time() + done)
+                for user_id in rng.sample(pool, min(args.players, len(pool))):
+                    game.add_participant(user_id, f"玩家{user_id}", None, 100 + user_id)
+            rolls = {user_id: rng.randint(1, 100) for user_id in game.participants}
+            ranked = sorted(rolls, key=rolls.get)
+            started = time.perf_counter()
+            b.stats_store.record_roll(chat_id, game, rolls, ranked[-1], ranked[0])
+            record_time += time.perf_counter() - started
+            game.last_roll_time = time.time()
+            done += 1
+        growth.append({"rolls": checkpoint, "query": await query_latency()})
+    results = {
+        "players_per_game": args.players,
+        "players_in_chat": args.stats_players,
+        "record_us_per_roll": round(record_time / done * 1e6, 3),
+        "growth": growth,
+    }
+
+    # 2. 大量群组、容量有限：换出到 SQLite，内存中的群组数保持在容量附近，重新读入的结果一致（其间一次写入失败）
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stats.db")
+        capacity = max(1, args.stats_chats // 10)
+        store = b.stats_store = b.StatsStore(path, capacity)
+        expected = {}
+        peak = 0
+        for c in range(args.stats_chats):
+            cid = -1008100000000 - c
+            game = b.Game(cid, 0, "主持人", time.time())
+            for user_id in range(args.players):
+                game.add_participant(user_id, f"玩家{user_id}", None, 100 + user_id)
+            for _ in range(5):
+                rolls = {user_id: rng.randint(1, 100) for user_id in game.participants}
+                ranked = sorted(rolls, key=rolls.get)
+                store.record_roll(cid, game, rolls, ranked[-1], ranked[0])
+                game.last_roll_time = time.time()
+            expected[cid] = (store.chats[cid].rolls, sorted(store.chats[cid].by_losses))
+            if c == 99:
+                # 第一批写入失败（如数据库被锁）：这些群组必须留在内存中，下次 flush 写入后才能换出
+                await _flush_after_failure(store, "_write", sqlite3.OperationalError("database is locked"))
+            elif c % 100 == 99:
+                await store.flush()
+            peak = max(peak, len(store.chats))
+        await store.flush()
+        cold = [cid for cid in expected if cid not in store.chats]
+        started = time.perf_counter()
+        reloaded = [store.get(cid) for cid in cold[:200]]
+        reload_seconds = time.perf_counter() - started
+        consistent = all(
+            (stats.rolls, sorted(stats.by_losses)) == expected[cid] for cid, stats in zip(cold, reloaded)
+        )
+        store.close()
+        results["eviction"] = {
+            "chats": args.stats_chats,
+            "capacity": capacity,
+            "peak_cached": peak,
+            "evictions": store.evictions,
+            "reload_ms_per_chat": round(reload_seconds / max(1, len(reloaded)) * 1000, 3),
+            "reload_consistent": consistent,
+        }
+    b.stats_store = b.StatsStore(None, b.STATS_CACHE_SIZE)
+    return results
+
+
+async def scenario_lifecycle(args) -> dict:
+    b = bot_module
+    factory = UpdateFactory()
+    fake_bot = FakeBot(args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+    harness = Harness(fake_bot)
+    # 使用 bot 真实的发送限速
+    (b.MAX_MESSAGES_PER_SECOND, b.MAX_MESSAGES_PER_CHAT_PER_MINUTE,
+        b.CHAT_BURST, b.MAX_CONCURRENT_SENDS) = _ORIGINAL["limits"]
+    b.pending_sends = 0
+    b.sender_lag = 0.0
+    b.background_failures.clear()
+    b.BACKGROUND_RESTART_DELAY = 0.05
+
+    sent_at = []
+    original_send = fake_bot.send_message
+
+    async def timed_send(*a, **kw):
+        sent_at.append(time.monotonic())
+        return await original_send(*a, **kw)
+
+    fake_bot.send_message = timed_send
+
+    crashes = []
+
+    async def crash_once(context):
+        if not crashes:
+            crashes.append(time.monotonic())
+            raise RuntimeError("injected failure")
+        await _ORIGINAL["message_queue_sender"](context)
+
+    b.message_queue_sender = crash_once
+    app = SimpleNamespace(bot=fake_bot)
+    try:
+        await b.start_background_tasks(app)
+        await asyncio.sleep(0.01)
+        health_after_crash = b.health_status()["problems"]
+
+        # 各群组创建游戏（每个一条回复），再让每个游戏都有一条到期的提醒排在定时队列里
+        for g in range(args.lifecycle_chats):
+            await harness.handle(factory.command(-1009000000000 - g, 90_000_000 + g, "/createnewgame"))
+        for (chat_id, thread_id), game in b.games.items():
+            game.timer_token = None
+            b.timer_queue.put_nowait((chat_id, thread_id, "⏰ 提醒", 10))
+        expected = harness.enqueued + len(b.games)
+        pending_at_stop = b.pending_sends + b.timer_queue.qsize()
+
+        started = time.monotonic()
+        await b.stop_background_tasks(app)
+        drain = time.monotonic() - started
+    finally:
+        b.message_queue_sender = _ORIGINAL["message_queue_sender"]
+        b.BACKGROUND_RESTART_DELAY = 1
+
+    # 任意 1 秒窗口内的最大发送条数
+    peak, left = 0, 0
+    for right in range(len(sent_at)):
+        while sent_at[right] - sent_at[left] >= 1:
+            left += 1
+        peak = max(peak, right - left + 1)
+    return {
+        "chats": args.lifecycle_chats,
+        "sender_restarts": b.background_failures.get("message_sender", (0,))[0],
+        "health_problems_after_crash": len(health_after_crash),
+        "pending_at_stop": pending_at_stop,
+        "expected_messages": expected,
+        "delivered": fake_bot.sent,
+        "lost": b.pending_sends,
+        "drain_seconds": round(drain, 3),
+        "drain_deadline_seconds": b.SHUTDOWN_DRAIN_TIMEOUT,
+        "global_limit_per_s": b.MAX_MESSAGES_PER_SECOND,
+        "avg_sends_per_s": round(fake_bot.sent / drain, 1) if drain else None,
+        "peak_sends_per_s": peak,
+        "within_limit": peak <= b.MAX_MESSAGES_PER_SECOND,
+        "tasks_left": len(b.background_tasks) + len(b.delivery_tasks),
+    }
+
+
+async def _lobby_run(args, lobby_mode) -> dict:
+    b = bot_module
+    factory = UpdateFactory()
+    fake_bot = FakeBot()
+    harness = Harness(fake_bot)
+    clock = b.time = VirtualClock()
+    b.LOBBY_MODE = lobby_mode
+    b.LOBBY_EDIT_DELAY = 0.05
+    harness.start_background()
+    rng = random.Random(args.seed)
+
+    groups = [(-1012000000000 - g, 120_000_000 + g) for g in range(args.lobby_groups)]
+    idle = [(-1012500000000 - g, 125_000_000 + g) for g in range(args.lobby_groups)]
+
+    async def phase(updates) -> None:
+        await harness.dispatch(updates, args.concurrency)
+        # 超过合并窗口，让延迟编辑都提交后再进入下一阶段
+        await asyncio.sleep(b.LOBBY_EDIT_DELAY * 3)
+        await harness.wait_delivered(args.drain_timeout)
+
+    try:
+        await phase([factory.command(chat_id, host, "/createnewgame") for chat_id, host in groups + idle])
+        # 玩家在开局后集中加入，其中有人重复发送 /join
+        joins = []
+        for chat_id, host in groups:
+            players = [host * 100 + p for p in range(args.players)]
+            joins += [factory.command(chat_id, user_id, "/join") for user_id in players]
+            joins.append(factory.command(chat_id, rng.choice(players), "/join"))
+        for chat_id, host in idle:
+            joins += [factory.command(chat_id, host * 100 + p, "/join") for p in range(3)]
+        await phase(joins)
+        for _ in range(args.lobby_rolls):
+            await phase([factory.command(chat_id, host, "/roll") for chat_id, host in groups])
+        await phase([factory.command(chat_id, host * 100, "/leave") for chat_id, host in groups])
+        await phase([factory.command(chat_id, host, "/roll") for chat_id, host in groups])
+        await phase([factory.command(chat_id, host, "/stop") for chat_id, host in groups])
+        # 闲置的游戏依次收到 10/20 分钟提醒，30 分钟后自动结束
+        for _ in range(3):
+            clock.advance(600)
+            await b.game_timer_check()
+            await b.timer_queue.join()
+            await phase([])
+    finally:
+        await harness.stop_background()
+        b.time = time
+        b.LOBBY_MODE = False
+
+    games = len(groups) + len(idle)
+    calls = dict(fake_bot.calls)
+    by_chat = fake_bot.sent_by_chat
+    return {
+        "games": games,
+        "api_calls": calls,
+        "calls_per_game": round(sum(calls.values()) / games, 2),
+        "sends_per_game": round(calls.get("sendMessage", 0) / games, 2),
+        "edits_per_game": round(calls.get("editMessageText", 0) / games, 2),
+        "max_sends_in_one_chat": max(by_chat.values()) if by_chat else 0,
+        "games_left": len(b.games),
+    }
+
+
+async def _lobby_deleted_run(args) -> dict:
+    """大厅消息被删除后陆续有人加入：应只补发一条新的大厅消息，之后继续编辑它"""
+    b = bot_module
+    factory = UpdateFactory()
+    fake_bot = FakeBot()
+    harness = Harness(fake_bot)
+    b.LOBBY_MODE = True
+    b.LOBBY_EDIT_DELAY = 0.05
+    harness.start_background()
+    chat_id, host = -1013000000000, 130_000_000
+    key = (chat_id, None)  # 非话题群组的 message_thread_id 为 None
+    joins = 4
+
+    async def phase(updates) -> None:
+        await harness.dispatch(updates, args.concurrency)
+        await asyncio.sleep(b.LOBBY_EDIT_DELAY * 3)
+        await harness.wait_delivered(args.drain_timeout)
+
+    try:
+        await phase([factory.command(chat_id, host, "/createnewgame")])
+        deleted_id = b.lobbies[key].message_id
+        fake_bot.deleted.add(deleted_id)
+        before = Counter(fake_bot.calls)
+        for p in range(joins):
+            await phase([factory.command(chat_id, host * 100 + p, "/join")])
+        lobby_id = b.lobbies[key].message_id
+        await phase([factory.command(chat_id, host, "/stop")])
+    finally:
+        await harness.stop_background()
+        b.LOBBY_MODE = False
+
+    calls = fake_bot.calls - before
+    return {
+        "joins_after_delete": joins,
+        "sends": calls.get("sendMessage", 0),
+        "edits": calls.get("editMessageText", 0),
+        "lobby_message_replaced": lobby_id != deleted_id,
+    }
+
+
+async def _lobby_spilled_run(args) -> dict:
+    """延迟编辑到期前游戏被换出：编辑不应把游戏读回内存，读回后的下一次变化再编辑大厅消息"""
+    b = bot_module
+    factory = UpdateFactory()
+    fake_bot = FakeBot()
+    harness = Harness(fake_bot)
+    tmp = tempfile.TemporaryDirectory()
+    b.LOBBY_MODE = True
+    b.LOBBY_EDIT_DELAY = 0.05
+    b.GAME_SPILL_IDLE = 600
+    b.spill_store = b.GameSpillStore(os.path.join(tmp.name, "spill.db"))
+    harness.start_background()
+    chat_id, host = -1014000000000, 140_000_000
+    key = (chat_id, None)
+
+    async def phase(updates) -> None:
+        await harness.dispatch(updates, args.concurrency)
+        await asyncio.sleep(b.LOBBY_EDIT_DELAY * 3)
+        await harness.wait_delivered(args.drain_timeout)
+
+    try:
+        await phase([factory.command(chat_id, host, "/createnewgame")])
+        await harness.dispatch([factory.command(chat_id, host + 1, "/join")], args.concurrency)
+        spilled = b.spill_idle_games(time.time() + b.GAME_SPILL_IDLE + 1)
+        before = Counter(fake_bot.calls)
+        await asyncio.sleep(b.LOBBY_EDIT_DELAY * 3)
+        await harness.wait_delivered(args.drain_timeout)
+        stayed_spilled = key not in b.games and key in b.spill_store.tokens
+        edits_while_spilled = (fake_bot.calls - before).get("editMessageText", 0)
+        await phase([factory.command(chat_id, host + 2, "/join")])
+        edits_after_reload = (fake_bot.calls - before).get("editMessageText", 0) - edits_while_spilled
+        await phase([factory.command(chat_id, host, "/stop")])
+    finally:
+        await harness.stop_background()
+        b.LOBBY_MODE = False
+        b.spill_store.close()
+        b.spill_store = None
+        b.GAME_SPILL_IDLE = 0
+        tmp.cleanup()
+
+    return {
+        "spilled": spilled,
+        "edits_while_spilled": edits_while_spilled,
+        "edits_after_reload": edits_after_reload,
+        "spilled_consistent": spilled == 1 and stayed_spilled and edits_while_spilled == 0 and edits_after_reload == 1,
+    }
+
+
+async def scenario_lobby(args) -> dict:
+    off = await _lobby_run(args, lobby_mode=False)
+    on = await _lobby_run(args, lobby_mode=True)
+    deleted = await _lobby_deleted_run(args)
+    spilled = await _lobby_spilled_run(args)
+    return {
+        "players_per_game": args.players,
+        "rolls_per_game": args.lobby_rolls + 1,
+        "lobby_off": off,
+        "lobby_on": on,
+        "call_reduction": round(1 - on["calls_per_game"] / off["calls_per_game"], 3),
+        "deleted_lobby": deleted,
+        "spilled_lobby": spilled,
+    }
+
+
+class VirtualClock:
+    """替换 bot 模块中的 time：time() 和 monotonic() 在真实时间上加一个可拨快的偏移量"""
+
+    def __init__(self):
+        self.offset = 0.0
+
+    def advance(self, seconds) -> None:
+        self.offset += seconds
+
+    def time(self) -> float:
+        return time.time() + self.offset
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+async def _soak_run(args, spill) -> dict:
+    b = bot_module
+    factory = UpdateFactory()
+    fake_bot = FakeBot()
+    harness = Harness(fake_bot, roll_cooldown=10)
+    clock = b.time = VirtualClock()
+    rng = random.Random(args.seed)
+    tmp = tempfile.TemporaryDirectory()
+    # 和默认配置一样把战绩写入 SQLite；容量取每轮的群组数，让战绩缓存很快稳定，不掩盖游戏占用的内存
+    b.stats_store = b.StatsStore(os.path.join(tmp.name, "stats.db"), args.soak_groups)
+    if spill:
+        b.GAME_SPILL_IDLE = 600
+        b.spill_store = b.GameSpillStore(os.path.join(tmp.name, "spill.db"))
+    harness.start_background()
+
+    def all_games() -> dict:
+        state = dict(b.games)
+        if b.spill_store is not None:
+            for row in b.spill_store.rows():
+                chat_id, thread_id, game = b._game_from_row(row)
+                state[(chat_id, thread_id)] = game
+        return state
+
+    samples, returning = [], []
+    tracemalloc.start()
+    try:
+        for r in range(args.soak_rounds):
+            # 新来的一批群组：开局、玩家加入、掷一次骰；三分之一正常结束，少数有人误用 /adminstop，其余闲置
+            updates = []
+            for g in range(args.soak_groups):
+                chat_id = -1011000000000 - r * args.soak_groups - g
+                host = 110_000_000 + r * args.soak_groups + g
+                updates.append(factory.command(chat_id, host, "/createnewgame"))
+                updates += [factory.command(chat_id, host * 100 + p, "/join") for p in range(args.players)]
+                updates.append(factory.command(chat_id, host, "/roll"))
+                if g % 3 == 0:
+                    updates.append(factory.command(chat_id, host, "/stop"))
+                elif g % 10 == 1:
+                    updates.append(factory.command(chat_id, host * 100, "/adminstop"))
+            await harness.dispatch(updates, args.concurrency)
+
+            # 之前几轮留下的游戏里有一部分又来了新玩家，换出的游戏在这里被读回
+            alive = sorted(key for key in all_games() if key[0] > -1011000000000 - r * args.soak_groups)
+            for chat_id, thread_id in rng.sample(alive, min(len(alive), args.soak_groups // 20)):
+                started = time.perf_counter()
+                await harness.handle(factory.command(chat_id, rng.randint(1, 10 ** 6), "/join"))
+                returning.append(time.perf_counter() - started)
+
+            # 5 分钟过去：到期的提醒和超时结束，以及后台的定期清理
+            clock.advance(300)
+            await b.game_timer_check()
+            await b.timer_queue.join()
+            await harness.wait_delivered(args.drain_timeout)
+            if b.spill_store is not None:
+                b.spill_idle_games(b.time.time())
+                await b.spill_store.flush()
+            b._sweep_chat_send_states(b.time.monotonic())
+            b.admin_cache.purge_expired(b.time.monotonic())
+            b.command_limiter.sweep(b.time.monotonic())
+            b.roll_cooldowns.sweep(b.time.time())
+            await b.stats_store.flush()
+            # 只统计 bot 模块中分配的内存，排除压测自身缓存的 Update 和延迟记录
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, b.__file__)])
+
+            samples.append({
+                "minutes": (r + 1) * 5,
+                "resident_games": len(b.games),
+                "spilled_games": len(b.spill_store.tokens) if b.spill_store is not None else 0,
+                "game_locks": len(b.game_locks),
+                "roll_cooldowns": len(b.roll_cooldowns.buckets),
+                "chat_send_states": len(b.chat_send_states),
+                "admin_cache": len(b.admin_cache._entries),
+                "timer_heap": len(b.timer_heap),
+                "bot_kb": sum(stat.size for stat in snapshot.statistics("filename")) // 1024,
+                "tracemalloc_kb": tracemalloc.get_traced_memory()[0] // 1024,
+            })
+        final = {key: (game.host_id, sorted(game.participants), game.timer_state) for key, game in all_games().items()}
+    finally:
+        tracemalloc.stop()
+        await harness.stop_background()
+        b.time = time
+        b.stats_store.close()
+        b.stats_store = b.StatsStore(None, b.STATS_CACHE_SIZE)
+        if b.spill_store is not None:
+            b.spill_store.close()
+            b.spill_store = None
+        b.GAME_SPILL_IDLE = 0
+        tmp.cleanup()
+
+    return {
+        "samples": samples[::max(1, len(samples) // 8)] + [samples[-1]],
+        "peak_bot_kb": max(sample["bot_kb"] for sample in samples),
+        "peak_resident_games": max(sample["resident_games"] for sample in samples),
+        "returning_join_latency": percentiles(returning),
+        "messages_sent": fake_bot.sent,
+        "final_state": final,
+    }
+
+
+async def scenario_soak(args) -> dict:
+    off = await _soak_run(args, spill=False)
+    on = await _soak_run(args, spill=True)
+    consistent = off.pop("final_state") == on.pop("final_state")
+    return {
+        "rounds": args.soak_rounds,
+        "groups_per_round": args.soak_groups,
+        "spill_off": off,
+        "spill_on": on,
+        "final_state_consistent": consistent,
+    }
+
+
+SCENARIOS = {
+    "workload": scenario_workload,
+    "timers": scenario_timers,
+    "ordering": scenario_ordering,
+    "memory": scenario_memory,
+    "restore": scenario_restore,
+    "render": scenario_render,
+    "flood": scenario_flood,
+    "eventlog": scenario_eventlog,
+    "stats": scenario_stats,
+    "lifecycle": scenario_lifecycle,
+    "lobby": scenario_lobby,
+    "soak": scenario_soak,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(prefix, value, out) -> None:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+
+
+def compare(old_path, new_path) -> None:
+    """并排打印两次结果中的数值指标及变化百分比"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_flat, new_flat = {}, {}
+    flatten("", old["scenarios"], old_flat)
+    flatten("", new["scenarios"], new_flat)
+    print(f"{'metric':60} {old.get('revision', 'old'):>14} {new.get('revision', 'new'):>14} {'change':>9}")
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        before, after = old_flat[key], new_flat[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else ""
+        print(f"{key:60} {before:>14} {after:>14} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="workload,timers,ordering,memory,restore,render,flood,eventlog,stats,lifecycle,lobby,soak",
+                        help="逗号分隔的场景列表: " + ",".join(SCENARIOS))
+    parser.add_argument("--groups", type=int, default=200, help="并发活跃的群组数")
+    parser.add_argument("--players", type=int, default=8, help="每个游戏的玩家数")
+    parser.add_argument("--ops", type=int, default=40, help="每个群组在加入之后的随机操作数")
+    parser.add_argument("--idle-games", type=int, default=2000, help="timers 场景的闲置游戏数")
+    parser.add_argument("--memory-games", type=int, default=10000, help="memory 场景的游戏数")
+    parser.add_argument("--restore-games", type=int, default=10000, help="restore 场景的游戏数")
+    parser.add_argument("--render-players", type=int, default=10000, help="render 场景的玩家数")
+    parser.add_argument("--render-rounds", type=int, default=20, help="render 场景的掷骰次数")
+    parser.add_argument("--flood-groups", type=int, default=50, help="flood 场景中正常游戏的群组数")
+    parser.add_argument("--flood-spammers", type=int, default=10, help="flood 场景中刷屏的账号数")
+    parser.add_argument("--flood-spam", type=int, default=5000, help="flood 场景中刷屏的命令数")
+    parser.add_argument("--flood-crowd", type=int, default=300, help="flood 场景中各发一次命令的账号数")
+    parser.add_argument("--eventlog-events", type=int, default=200000, help="eventlog 场景合成的事件数")
+    parser.add_argument("--stats-rolls", type=int, default=1000000, help="stats 场景单个群组累计的掷骰次数")
+    parser.add_argument("--stats-players", type=int, default=2000, help="stats 场景单个群组的玩家总数")
+    parser.add_argument("--stats-chats", type=int, default=5000, help="stats 场景测试换出时的群组数")
+    parser.add_argument("--lifecycle-chats", type=int, default=150, help="lifecycle 场景退出时有待发消息的群组数")
+    parser.add_argument("--lobby-groups", type=int, default=200, help="lobby 场景中完整进行一局的群组数（另有同样数量的闲置游戏）")
+    parser.add_argument("--lobby-rolls", type=int, default=3, help="lobby 场景中每局离开前的掷骰次数")
+    parser.add_argument("--soak-rounds", type=int, default=24, help="soak 场景的轮数（每轮虚拟时间 5 分钟）")
+    parser.add_argument("--soak-groups", type=int, default=100, help="soak 场景每轮新来的群组数")
+    parser.add_argument("--concurrency", type=int, default=64, help="同时处理的更新数")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="注入的 Bot API 往返延迟")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="延迟的随机抖动范围")
+    parser.add_argument("--real-limits", action="store_true", help="保留 bot 真实的发送速率限制")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="等待消息发送完成的最长时间")
+    parser.add_argument("--trace-memory", action="store_true", help="workload 场景中启用 tracemalloc")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="比较两次结果文件")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "scenarios": {},
+    }
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        if name not in SCENARIOS:
+            parser.error(f"未知场景 {name}")
+        results["scenarios"][name] = asyncio.run(SCENARIOS[name](args))
+        print(f"[{name}] {json.dumps(results['scenarios'][name], ensure_ascii=False)}", file=sys.stderr)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = failed_checks(results["scenarios"])
+    if failed:
+        print(f"检查未通过: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
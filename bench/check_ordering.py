@@ -0,0 +1,152 @@
+"""ChatOrderedUpdateProcessor 的顺序压力检查
+
+把大量分属不同群组、交错到达的 create/join/leave/stop/roll 更新交给 bot 实际使用的
+ChatOrderedUpdateProcessor 并发处理。每条更新的处理函数和 bot 的命令处理一样跨 await 读改写
+所在群组的状态（先读出、随机等待、再写回），最后检查：
+
+- 每个群组的最终状态（主持人、参与者、掷骰次数）与顺序重放的结果完全一致
+- 每个群组内更新的处理顺序与到达顺序一致
+- 确实有多个更新同时处理，且同时处理的数量不超过上限
+
+任何一项不通过时以非零状态退出。--unordered 不经过处理器直接并发执行同样的更新，
+用来确认这个检查能发现乱序（此时应当失败）。
+
+用法:
+    python bench/check_ordering.py --updates 6000 --chats 60 --concurrency 64
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:offline-benchmark")
+
+import truth_dare_bot as bot_module  # noqa: E402
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+COMMANDS = ("/createnewgame", "/join", "/leave", "/stop", "/roll")
+
+
+def make_updates(args) -> list:
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now()
+    updates = []
+    for update_id in range(1, args.updates + 1):
+        chat_id = -1009000000000 - rng.randrange(args.chats)
+        # 一半的群组开启了话题，同一群组不同话题的游戏互不影响
+        thread_id = rng.choice((1, 2)) if chat_id % 2 else None
+        user_id = rng.randint(1, 12)
+        text = rng.choices(COMMANDS, weights=(1, 8, 3, 1, 2))[0]
+        message = Message(
+            update_id, now, Chat(chat_id, Chat.SUPERGROUP),
+            from_user=User(user_id, f"user{user_id}", False), text=text, message_thread_id=thread_id
+        )
+        updates.append(Update(update_id, message=message))
+    return updates
+
+
+def _key(update):
+    return update.effective_chat.id, update.effective_message.message_thread_id
+
+
+def apply_command(game, user_id, text):
+    """按命令返回游戏的新状态 (主持人, 参与者, 掷骰次数)，没有游戏时为 None"""
+    if text == "/createnewgame":
+        return game or (user_id, frozenset(), 0)
+    if game is None:
+        return None
+    host, participants, rolls = game
+    if text == "/join":
+        return host, participants | {user_id}, rolls
+    if text == "/leave":
+        return host, participants - {user_id}, rolls
+    if text == "/stop":
+        return None if user_id == host else game
+    if user_id == host and len(participants) >= 2:
+        return host, participants, rolls + 1
+    return game
+
+
+def replay(updates) -> dict:
+    state = {}
+    for update in updates:
+        key = _key(update)
+        state[key] = apply_command(state.get(key), update.effective_user.id, update.message.text)
+    return {key: game for key, game in state.items() if game is not None}
+
+
+async def run_concurrent(updates, args) -> dict:
+    jitter = random.Random(args.seed + 1)
+    state = {}
+    handled = {}
+    in_flight = peak = 0
+
+    async def handle(update):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            key = _key(update)
+            game = state.get(key)
+            await asyncio.sleep(jitter.random() * args.max_delay)
+            state[key] = apply_command(game, update.effective_user.id, update.message.text)
+            handled.setdefault(key, []).append(update.update_id)
+            await asyncio.sleep(jitter.random() * args.max_delay)
+        finally:
+            in_flight -= 1
+
+    if args.unordered:
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def unordered(update):
+            async with slots:
+                await handle(update)
+
+        await asyncio.gather(*[unordered(u) for u in updates])
+    else:
+        processor = bot_module.ChatOrderedUpdateProcessor(args.concurrency)
+        await asyncio.gather(*[processor.process_update(u, handle(u)) for u in updates])
+
+    arrived = {}
+    for update in updates:
+        arrived.setdefault(_key(update), []).append(update.update_id)
+    return {
+        "state": {key: game for key, game in state.items() if game is not None},
+        "in_order": handled == arrived,
+        "peak": peak,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=6000)
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=64, help="MAX_CONCURRENT_UPDATES")
+    parser.add_argument("--max-delay", type=float, default=0.002, help="处理函数中每次随机等待的最长秒数")
+    parser.add_argument("--unordered", action="store_true", help="不经过 ChatOrderedUpdateProcessor，只限制并发数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    updates = make_updates(args)
+    sequential = replay(updates)
+    concurrent = asyncio.run(run_concurrent(updates, args))
+    result = {
+        "updates": len(updates),
+        "games": len(sequential),
+        "peak_concurrency": concurrent["peak"],
+        "within_limit": 1 < concurrent["peak"] <= args.concurrency,
+        "in_order": concurrent["in_order"],
+        "consistent": concurrent["state"] == sequential,
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    if not (result["within_limit"] and result["in_order"] and result["consistent"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
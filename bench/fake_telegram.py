@@ -0,0 +1,326 @@
+"""离线的 Telegram Bot API 替身，用于在没有 Telegram 的情况下端到端驱动 bot
+
+启动一个本地 HTTP 服务模拟 Bot API（getMe、setWebhook、getUpdates、sendMessage 等），
+然后以子进程方式运行 truth_dare_bot.py，并通过 TELEGRAM_API_BASE_URL 指向这个替身：
+
+- polling 模式：命令放进替身的 getUpdates 队列，由 bot 长轮询取走
+- webhook 模式：命令以 Update JSON 的形式直接 POST 到 bot 的 webhook 地址
+
+每条命令记录从发出到替身收到 bot 回复（sendMessage 的 reply_to）的耗时，用来对比两种模式的端到端延迟。
+
+scaling 模式以 WORKERS=1、2、4… 分别启动 bot，一次性放入 count 条分属不同群组的 /createnewgame，
+统计收齐全部回复所需的时间，用来观察多进程分片的吞吐量随进程数的变化（全局发送限速在此模式下放开）。
+
+用法:
+    python bench/fake_telegram.py --mode both --count 200
+    python bench/fake_telegram.py --mode scaling --workers 1,2,4 --count 5000
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_TOKEN = "123456:offline-test-token"
+SECRET_TOKEN = "offline-secret"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_tod_bot"}
+
+
+class FakeTelegram:
+    """Bot API 替身的状态：待取走的更新、已收到的回复"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.updates = []
+        self.next_message_id = 1
+        self.webhook_set = threading.Event()
+        self.polling_started = threading.Event()
+        self.sent_at = {}  # message_id -> 命令发出时间
+        self.replied = {}  # message_id -> 收到回复的时间
+        self.sent_messages = []
+
+    def push_update(self, update) -> None:
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def push_updates(self, updates) -> None:
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def get_updates(self, offset, timeout, limit=100) -> list:
+        self.polling_started.set()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+                self.updates = pending
+                if pending:
+                    return pending[:limit]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+
+    def record_reply(self, params) -> dict:
+        now = time.perf_counter()
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.sent_messages.append(params)
+            reply = params.get("reply_parameters") or {}
+            reply_to = reply.get("message_id") or params.get("reply_to_message_id")
+            if reply_to is not None and reply_to not in self.replied:
+                self.replied[reply_to] = now
+                self.cond.notify_all()
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": params["chat_id"], "type": "supergroup" if int(params["chat_id"]) < 0 else "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def wait_replies(self, count, timeout) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.replied) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def wait_reply(self, message_id, timeout) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while message_id not in self.replied:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+
+def make_handler(fake: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _params(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode() if length else ""
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                return json.loads(body or "{}")
+            params = {}
+            for key, values in parse_qs(body).items():
+                try:
+                    params[key] = json.loads(values[0])
+                except ValueError:
+                    params[key] = values[0]
+            return params
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            params = self._params()
+            if method == "getMe":
+                result = BOT_USER
+            elif method == "setWebhook":
+                fake.webhook_set.set()
+                result = True
+            elif method in ("deleteWebhook", "close", "logOut"):
+                result = True
+            elif method == "getUpdates":
+                result = fake.get_updates(
+                    int(params.get("offset") or 0), float(params.get("timeout") or 0), int(params.get("limit") or 100)
+                )
+            elif method == "sendMessage":
+                result = fake.record_reply(params)
+            elif method == "editMessageText":
+                result = True
+            elif method == "getChatMember":
+                result = {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "u"}}
+            elif method == "getChatAdministrators":
+                result = []
+            else:
+                result = True
+            body = json.dumps({"ok": True, "result": result}).encode()
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # bot 退出时正在进行的长轮询会被断开
+                pass
+
+    return Handler
+
+
+def make_update(update_id, chat_id, user_id, text) -> dict:
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def post_webhook(port, path, update) -> None:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/{path}",
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN},
+    )
+    urllib.request.urlopen(request, timeout=10).read()
+
+
+def start_bot(api_port, webhook_port, mode, **extra_env):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=FAKE_TOKEN,
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{api_port}",
+        BOT_MODE=mode,
+        WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}",
+        WEBHOOK_LISTEN="127.0.0.1",
+        WEBHOOK_PORT=str(webhook_port),
+        WEBHOOK_PATH="telegram",
+        WEBHOOK_SECRET_TOKEN=SECRET_TOKEN,
+        GAME_STORE="memory",
+        STATS_DB_PATH="",
+    )
+    env.update(extra_env)
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "truth_dare_bot.py")], cwd=ROOT, env=env)
+
+
+def stop_bot(bot, server) -> None:
+    bot.send_signal(signal.SIGINT)
+    try:
+        bot.wait(30)  # bot 退出前会先发完待发消息
+    except subprocess.TimeoutExpired:
+        bot.kill()
+    server.shutdown()
+    server.server_close()
+
+
+def run_mode(mode, count, api_port, webhook_port) -> dict:
+    fake = FakeTelegram()
+    server = ThreadingHTTPServer(("127.0.0.1", api_port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    bot = start_bot(api_port, webhook_port, mode)
+    try:
+        ready = fake.webhook_set if mode == "webhook" else fake.polling_started
+        if not ready.wait(30):
+            raise RuntimeError(f"{mode} 模式的 bot 未能启动")
+        time.sleep(0.5)
+
+        latencies = []
+        lost = 0
+        for i in range(1, count + 1):
+            # 每条命令使用不同的聊天，避免触发单个聊天的发送限速
+            update = make_update(i, chat_id=1000 + i, user_id=1000 + i, text="/help")
+            fake.sent_at[i] = time.perf_counter()
+            if mode == "webhook":
+                post_webhook(webhook_port, "telegram", update)
+            else:
+                fake.push_update(update)
+            if fake.wait_reply(i, timeout=10):
+                latencies.append((fake.replied[i] - fake.sent_at[i]) * 1000)
+            else:
+                lost += 1
+            # 保持在全局发送速率以内
+            time.sleep(0.05)
+    finally:
+        stop_bot(bot, server)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "commands": count,
+        "lost": lost,
+        "mean_ms": round(statistics.mean(latencies), 2) if latencies else None,
+        "p50_ms": round(latencies[len(latencies) // 2], 2) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2) if latencies else None,
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+    }
+
+
+def run_scaling(workers, count, api_port, webhook_port) -> dict:
+    fake = FakeTelegram()
+    server = ThreadingHTTPServer(("127.0.0.1", api_port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # 每个群组只发一条命令，避开单群组限速；全局限速调到足够大，只测处理能力
+    bot = start_bot(api_port, webhook_port, "polling", WORKERS=str(workers), MAX_MESSAGES_PER_SECOND="1000000")
+    try:
+        if not fake.polling_started.wait(30):
+            raise RuntimeError("bot 未能启动")
+        # 预热：每个工作进程各处理一条命令，确认都已就绪
+        warmup = [make_update(i, chat_id=-(10 ** 12) - i, user_id=i, text="/help") for i in range(1, workers + 1)]
+        fake.push_updates(warmup)
+        if not fake.wait_replies(workers, timeout=60):
+            raise RuntimeError("工作进程未能就绪")
+
+        first = workers + 1
+        updates = [
+            make_update(i, chat_id=-(10 ** 12) - i, user_id=i, text="/createnewgame")
+            for i in range(first, first + count)
+        ]
+        started = time.perf_counter()
+        fake.push_updates(updates)
+        completed = fake.wait_replies(workers + count, timeout=300)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_bot(bot, server)
+
+    replied = len(fake.replied) - workers
+    return {
+        "workers": workers,
+        "commands": count,
+        "replied": replied,
+        "completed": completed,
+        "seconds": round(elapsed, 3),
+        "updates_per_s": round(replied / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("polling", "webhook", "both", "scaling"), default="both")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", default="1,2,4", help="scaling 模式下依次测试的进程数")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--webhook-port", type=int, default=18443)
+    args = parser.parse_args()
+
+    if args.mode == "scaling":
+        counts = [int(n) for n in args.workers.split(",")]
+        results = [run_scaling(n, args.count, args.api_port, args.webhook_port) for n in counts]
+        baseline = results[0]["updates_per_s"]
+        for result in results:
+            result["speedup"] = round(result["updates_per_s"] / baseline, 2)
+    else:
+        modes = ("polling", "webhook") if args.mode == "both" else (args.mode,)
+        results = [run_mode(mode, args.count, args.api_port, args.webhook_port) for mode in modes]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,28 @@
 import os
+import sys
+import html
 import random
 import time
 import logging
 import asyncio
-from telegram import Update, ChatMemberAdministrator, ChatMemberOwner
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackContext
+import json
+import math
+import re
+import sqlite3
+import threading
+import multiprocessing
+import queue
+import signal
+import heapq
+import bisect
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from telegram import Update, ChatMemberAdministrator, ChatMemberOwner, ReplyParameters
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, ApplicationHandlerStop, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, ContextTypes, CallbackContext, TypeHandler
 from dotenv import load_dotenv
-from asyncio import Lock, Queue
+from asyncio import Event, Lock, PriorityQueue, Queue, Semaphore
 
 # 配置日志
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.ERROR)
@@ -17,28 +33,1237 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise ValueError("错误: 未在 .env 文件或环境变量中找到 TELEGRAM_BOT_TOKEN！")
 
-# 记录
+# 运行模式：polling（默认）或 webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # 对外可访问的地址，如 https://example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")  # 自建 Bot API 服务或离线测试用的替身，如 http://127.0.0.1:8081
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"错误: 未知的 BOT_MODE {BOT_MODE}，可选 polling 或 webhook")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("错误: webhook 模式需要在 .env 中设置 WEBHOOK_URL！")
+
+# 需要接收的更新类型：chat_member 默认不推送，需要显式订阅才能让管理员缓存及时失效
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CHAT_MEMBER, Update.MY_CHAT_MEMBER]
+
+# 最多同时处理的更新数，不同群组/话题的更新并发处理，同一游戏内的更新仍按顺序处理
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# 多进程分片：WORKERS > 1 时由前端进程接收更新，按 chat_id 分给各工作进程处理
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_CHECK_INTERVAL = 1  # 前端检查工作进程存活的间隔(秒)
+if WORKERS < 1:
+    raise ValueError(f"错误: WORKERS 必须大于等于 1，当前为 {WORKERS}")
+
+# 进行中的游戏：(chat_id, thread_id) -> Game
 games = {}
-last_roll_time = {}
 
-# 全局锁
-games_lock = Lock()
-last_roll_lock = Lock()
+# 大厅消息模式下每个游戏的状态消息：(chat_id, thread_id) -> Lobby
+lobbies = {}
+
+# 按游戏 (chat_id, thread_id) 划分的锁，随游戏创建、随游戏清理，不同群组之间互不阻塞
+game_locks = {}
 
 # 消息队列和定时器管理
-message_queue = Queue()
+# message_queue 中的元素为 (优先级, 序号, OutboundMessage)，优先级数字越小越先发送
+message_queue = PriorityQueue()
+_message_seq = itertools.count()
+chat_send_states = {}
 timer_queue = Queue()
 
+# 发送器状态：尚未发送完成的消息数（含排队、限速推迟和发送中的），最近一次取出消息的时间，最近发出消息的排队时长
+pending_sends = 0
+sender_heartbeat = 0.0
+sender_lag = 0.0
+delivery_tasks = set()  # 进行中的 _deliver 任务；事件循环只持有任务的弱引用，必须自己保存
+
+# 多进程模式下由前端进程创建、所有工作进程共享的全局发送额度；单进程时为 None
+send_budget = None
+# 工作进程负责的分片 (序号, 总数)；单进程时为 None
+shard = None
+
+# 游戏超时调度：按截止时间排序的最小堆 (deadline, seq, chat_id, thread_id)
+# 游戏里的 timer_token 记录当前有效条目的 seq，主持人操作后重新入堆，旧条目在出堆时丢弃
+timer_heap = []
+timer_wakeup = Event()
+_timer_seq = itertools.count()
+_stale_timers = 0
+
 # 定时器常量
-TIMER_INTERVAL = 60  # 检查间隔(秒)
+TIMER_INTERVAL = 60  # 调度器最长休眠时间(秒)，截止时间到达时会被提前唤醒
 WARNING_10_MIN = 600 # 第一次提醒间隔
 WARNING_20_MIN = 1200 # 第二次提醒间隔
 GAME_TIMEOUT = 1800 # 第三次结束游戏间隔
-MAX_MESSAGES_PER_SECOND = 28  # 限制提醒的发送速率，以防撞上TG的限制。
+
+# 计时阶段：当前 timer_state -> (距主持人最后操作的间隔, 下一个 timer_state, 提醒内容)
+TIMER_STAGES = {
+    0: (WARNING_10_MIN, 10, "⏰ 本轮游戏已经过去10分钟咯"),
+    10: (WARNING_20_MIN, 20, "⏰ 本轮游戏已经过去20分钟咯，如果超过30分钟主持人无操作，本次游戏将自动结束"),
+    20: (GAME_TIMEOUT, 30, "⏰ 超过30分钟无操作，游戏已自动结束"),
+}
+
+# 发送速率常量
+MAX_MESSAGES_PER_SECOND = int(os.getenv("MAX_MESSAGES_PER_SECOND", "28"))  # 全局发送速率，以防撞上TG的限制；多进程时为所有工作进程合计
+MAX_MESSAGES_PER_CHAT_PER_MINUTE = 20  # 单个群组每分钟最多发送条数
+CHAT_BURST = 3  # 单个群组允许的瞬时突发条数
+GLOBAL_BURST = 1  # 全局令牌桶容量：为 1 时任意 1 秒内最多发送 MAX_MESSAGES_PER_SECOND 条（容量等于每秒额度时，空闲后 1 秒内可发出近两倍）
+MAX_CONCURRENT_SENDS = 8  # 同时进行中的发送请求数
+MAX_SEND_ATTEMPTS = 3  # 网络错误时的最多尝试次数
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "15"))  # 退出时等待定时任务和待发消息处理完的最长时间(秒)
+if SHUTDOWN_DRAIN_TIMEOUT < 0:
+    raise ValueError("错误: SHUTDOWN_DRAIN_TIMEOUT 不能小于0")
+BACKGROUND_RESTART_DELAY = 1  # 后台循环异常退出后的重启等待(秒)，连续失败时加倍
+BACKGROUND_RESTART_MAX_DELAY = 60
+HEALTH_CHECK_INTERVAL = 30  # 健康检查间隔(秒)，状态变化时写日志
+HEALTH_STALL_SECONDS = 30  # 队列中有可发送的消息但发送器超过该时间没有取出，视为卡住
+HEALTH_MAX_SEND_LAG = float(os.getenv("HEALTH_MAX_SEND_LAG", "60"))  # 消息从入队到开始发送超过该秒数，视为发送跟不上
+PRIORITY_REPLY = 0  # 命令回复、掷骰结果
+PRIORITY_REMINDER = 1  # 定时提醒
+
+# 掷骰常量
+ROLL_COOLDOWN = 10  # 两次掷骰的最小间隔(秒)
+MAX_TIE_REROLLS = int(os.getenv("MAX_TIE_REROLLS", "5"))  # 每组并列玩家最多加赛轮数，超过则请主持人手动处理
+ROLL_COMPACT_THRESHOLD = int(os.getenv("ROLL_COMPACT_THRESHOLD", "0"))  # 玩家数超过该值时只列出最高和最低的若干名，0 为始终列出全部
+ROLL_COMPACT_K = int(os.getenv("ROLL_COMPACT_K", "10"))  # 精简模式下最高、最低各列出的人数
+MAX_MESSAGE_LENGTH = 4096  # Telegram 单条消息的长度上限（解析 HTML 之后，按 UTF-16 码元计）
+
+# 大厅消息模式：每个游戏只发一条状态消息，加入/离开、加赛情况和计时提醒都改为编辑这条消息
+LOBBY_MODE = os.getenv("LOBBY_MODE", "false").lower() in ("1", "true", "yes")
+LOBBY_EDIT_DELAY = float(os.getenv("LOBBY_EDIT_DELAY", "2"))  # 状态变化后等待多少秒再编辑，期间的连续 /join 合并为一次编辑
+if LOBBY_EDIT_DELAY < 0:
+    raise ValueError("错误: LOBBY_EDIT_DELAY 不能小于0")
+
+# 命令限流：命令 -> (每用户次数, 周期秒, 每群组次数, 周期秒)，令牌桶容量为次数、按 次数/周期 匀速补充
+# 可在 .env 中用 COMMAND_RATE_LIMITS="join=3/30,60/60;help=2/60,5/60" 的格式覆盖
+COMMAND_RATE_LIMITS = {
+    'start': (3, 60, 10, 60),
+    'help': (3, 60, 10, 60),
+    'createnewgame': (3, 60, 6, 60),
+    'stop': (3, 60, 6, 60),
+    'join': (4, 30, 60, 60),
+    'leave': (4, 30, 60, 60),
+    'roll': (10, 60, 20, 60),
+    'adminstop': (3, 60, 6, 60),
+    'stats': (6, 60, 12, 60),
+    'top': (3, 60, 6, 60),
+    'mystats': (3, 60, 20, 60),
+}
+for _rule in filter(None, os.getenv("COMMAND_RATE_LIMITS", "").replace(" ", "").split(";")):
+    try:
+        _command, _limits = _rule.split("=")
+        (_user_count, _user_period), (_chat_count, _chat_period) = (part.split("/") for part in _limits.split(","))
+        COMMAND_RATE_LIMITS[_command.lstrip("/")] = (int(_user_count), float(_user_period), int(_chat_count), float(_chat_period))
+    except ValueError:
+        raise ValueError(f"错误: 无法解析 COMMAND_RATE_LIMITS 中的 {_rule}，格式为 命令=用户次数/秒,群组次数/秒")
+FLOOD_PROTECTION = os.getenv("FLOOD_PROTECTION", "true").lower() in ("1", "true", "yes")
+FLOOD_NOTICE_INTERVAL = 30  # 同一用户在同一群组被限流时，最多每隔多少秒提示一次，其余直接丢弃
+RATE_LIMIT_MAX_BUCKETS = 100000  # 每类限流记录的令牌桶上限
+RATE_LIMIT_SWEEP_INTERVAL = 60  # 清理已补满（不活跃）令牌桶的间隔(秒)
+
+# 群管理员缓存
+ADMIN_CACHE_TTL = 300  # 管理员列表缓存时间(秒)，成员变动时会提前失效
+ADMIN_CACHE_SIZE = 4096  # 最多缓存的群组数
+
+# 运行指标（默认关闭）
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+BOT_ADMIN_IDS = {int(x) for x in os.getenv("BOT_ADMIN_IDS", "").replace(",", " ").split()}  # 可以使用 /stats 的用户
+
+# 存储配置
+GAME_STORE = os.getenv("GAME_STORE", "memory")  # memory：仅内存；sqlite/eventlog：持久化，重启后恢复进行中的游戏
+GAME_DB_PATH = os.getenv("GAME_DB_PATH", "games.db")
+GAME_STORE_FLUSH_INTERVAL = 0.5  # 批量写入间隔(秒)
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "events")  # 事件日志和快照所在目录
+EVENT_LOG_SNAPSHOT_EVENTS = int(os.getenv("EVENT_LOG_SNAPSHOT_EVENTS", "50000"))  # 累计多少条事件后做一次快照
+EVENT_LOG_SNAPSHOT_INTERVAL = int(os.getenv("EVENT_LOG_SNAPSHOT_INTERVAL", "600"))  # 有新事件时最长多久做一次快照(秒)
+EVENT_LOG_FSYNC = os.getenv("EVENT_LOG_FSYNC", "false").lower() in ("1", "true", "yes")  # 每批事件写入后是否 fsync
+EVENT_LOG_ARCHIVE = os.getenv("EVENT_LOG_ARCHIVE", "false").lower() in ("1", "true", "yes")  # 快照后把旧分段移入 archive/ 而不是删除
+if EVENT_LOG_SNAPSHOT_EVENTS <= 0 or EVENT_LOG_SNAPSHOT_INTERVAL <= 0:
+    raise ValueError("错误: EVENT_LOG_SNAPSHOT_EVENTS 和 EVENT_LOG_SNAPSHOT_INTERVAL 必须大于0")
+
+# 闲置游戏换出：主持人长时间无操作（但还没超时）的游戏写入本地 SQLite，只在内存中保留键，下次有命令时读回
+GAME_SPILL_IDLE = int(os.getenv("GAME_SPILL_IDLE", "0"))  # 主持人超过该秒数无操作的游戏换出，0 为不按闲置时间换出
+MAX_RESIDENT_GAMES = int(os.getenv("MAX_RESIDENT_GAMES", "0"))  # 内存中最多保留的游戏数，超出时先换出最久无操作的，0 为不限
+GAME_SPILL_PATH = os.getenv("GAME_SPILL_PATH", "spill.db")
+if GAME_SPILL_IDLE < 0 or MAX_RESIDENT_GAMES < 0:
+    raise ValueError("错误: GAME_SPILL_IDLE 和 MAX_RESIDENT_GAMES 不能小于0")
+MEMORY_JANITOR_INTERVAL = 60  # 换出闲置游戏、清理空闲的发送状态和过期管理员缓存的间隔(秒)
+
+# 战绩统计（/top、/mystats）
+STATS_DB_PATH = os.getenv("STATS_DB_PATH", "stats.db")  # 留空则只保存在内存中，重启后丢失
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "2000"))  # 内存中最多保留多少个群组的战绩，超出后换出最久未用的群组
+if STATS_CACHE_SIZE <= 0:
+    raise ValueError("错误: STATS_CACHE_SIZE 必须大于0")
+STATS_FLUSH_INTERVAL = 5  # 战绩批量写入间隔(秒)
+STATS_TOP_K = 10  # /top 每个榜单列出的人数
+
+
+def _message_link_prefix(chat_id) -> str:
+    """加入消息链接的公共前缀，同一群组的所有游戏共用一个字符串"""
+    if isinstance(chat_id, int) and chat_id < 0:
+        chat_id_str = str(chat_id)[4:]  # 处理超级群ID
+    else:
+        chat_id_str = str(chat_id)
+    return sys.intern(f"https://t.me/c/{chat_id_str}/")
+
+
+class Participant:
+    """游戏参与者，只保存结果中需要展示的字段"""
+    __slots__ = ('full_name', 'username', 'message_id', 'display', 'display_length')
+
+    def __init__(self, full_name, username, message_id, link_prefix):
+        self.full_name = full_name
+        self.username = username
+        self.message_id = message_id
+        # 掷骰结果中的一行前缀及其显示长度，加入时生成一次，之后每次 /roll 直接复用
+        self.display = f'<a href="{link_prefix}{message_id}">🔗 </a>{html.escape(full_name)}'
+        self.display_length = _visible_length(self.display)
+
+    @property
+    def mention(self) -> str:
+        return f"@{self.username}" if self.username else html.escape(self.full_name)
+
+
+class Game:
+    """一局游戏：主持人、参与者（按加入顺序）、计时状态和掷骰冷却"""
+    __slots__ = (
+        'host_id', 'host_name', 'participants', 'link_prefix', 'game_start_time',
+        'host_last_active', 'timer_state', 'timer_token', 'last_roll_time'
+    )
+
+    def __init__(self, chat_id, host_id, host_name, current_time):
+        self.host_id = host_id
+        self.host_name = host_name
+        self.participants = {}  # user_id -> Participant
+        self.link_prefix = _message_link_prefix(chat_id)
+        self.game_start_time = current_time
+        self.host_last_active = current_time
+        self.timer_state = 0
+        self.timer_token = None  # 计时堆中当前有效条目的序号
+        self.last_roll_time = None
+
+    def add_participant(self, user_id, full_name, username, message_id) -> Participant:
+        participant = self.participants[user_id] = Participant(full_name, username, message_id, self.link_prefix)
+        return participant
+
+
+class MemoryGameStore:
+    """默认存储：游戏只保存在内存中，重启后丢失"""
+
+    def load_games(self) -> list:
+        return []
+
+    def save_game(self, chat_id, thread_id, game) -> None:
+        pass
+
+    def delete_game(self, chat_id, thread_id) -> None:
+        pass
+
+    def record_event(self, kind, chat_id, thread_id, ts, *fields) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteGameStore:
+    """SQLite（WAL 模式）持久化存储
+
+    save_game/delete_game 只在内存中记下有变化的游戏，同一游戏多次修改会被合并；
+    flush() 把这段时间内的所有变化放在一个事务里写入，写入在线程池中进行，不阻塞事件循环。
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # WAL 下只在检查点时 fsync
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            " chat_id INTEGER NOT NULL,"
+            " thread_id INTEGER NOT NULL,"  # 非话题群组的 None 存为 0
+            " host_id INTEGER NOT NULL,"
+            " host_name TEXT NOT NULL,"
+            " game_start_time REAL NOT NULL,"
+            " host_last_active REAL NOT NULL,"
+            " timer_state INTEGER NOT NULL,"
+            " last_roll_time REAL,"
+            " participants TEXT NOT NULL,"
+            " PRIMARY KEY (chat_id, thread_id))"
+        )
+        self._conn.commit()
+        self._write_lock = threading.Lock()
+        self._dirty = {}  # (chat_id, thread_id) -> Game，None 表示删除
+        self._closed = False
+
+    def load_games(self) -> list:
+        """返回 [(chat_id, thread_id, game)]"""
+        rows = self._conn.execute(
+            "SELECT chat_id, thread_id, host_id, host_name, game_start_time,"
+            " host_last_active, timer_state, last_roll_time, participants FROM games"
+        ).fetchall()
+        restored = []
+        for (chat_id, thread_id, host_id, host_name, game_start_time,
+                host_last_active, timer_state, last_roll, participants) in rows:
+            game = Game(chat_id, host_id, host_name, game_start_time)
+            game.host_last_active = host_last_active
+            game.timer_state = timer_state
+            game.last_roll_time = last_roll
+            for user_id, full_name, username, message_id in json.loads(participants):
+                game.add_participant(user_id, full_name, username, message_id)
+            restored.append((chat_id, thread_id or None, game))
+        return restored
+
+    def save_game(self, chat_id, thread_id, game) -> None:
+        self._dirty[(chat_id, thread_id)] = game
+
+    def delete_game(self, chat_id, thread_id) -> None:
+        self._dirty[(chat_id, thread_id)] = None
+
+    def record_event(self, kind, chat_id, thread_id, ts, *fields) -> None:
+        pass  # 按整局游戏保存，不需要事件
+
+    def _take_pending(self):
+        """在事件循环里取出待写入的变化并序列化成行，之后写库时不再访问共享的游戏数据"""
+        dirty, self._dirty = self._dirty, {}
+        upserts, deletes = [], []
+        for (chat_id, thread_id), game in dirty.items():
+            if game is None:
+                deletes.append((chat_id, thread_id or 0))
+                continue
+            participants = json.dumps(
+                [
+                    [user_id, participant.full_name, participant.username, participant.message_id]
+                    for user_id, participant in game.participants.items()
+                ],
+                ensure_ascii=False
+            )
+            upserts.append((
+                chat_id, thread_id or 0, game.host_id, game.host_name, game.game_start_time,
+                game.host_last_active, game.timer_state, game.last_roll_time, participants
+            ))
+        return dirty, upserts, deletes
+
+    def _write(self, upserts, deletes) -> None:
+        with self._write_lock:
+            if self._closed:
+                return
+            with self._conn:
+                if deletes:
+                    self._conn.executemany("DELETE FROM games WHERE chat_id = ? AND thread_id = ?", deletes)
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", upserts
+                    )
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        dirty, upserts, deletes = self._take_pending()
+        try:
+            await asyncio.to_thread(self._write, upserts, deletes)
+        except BaseException:
+            # 写入失败（如数据库被锁）时放回这批变化，下次 flush 重试；期间又有变化的游戏以新的为准
+            for key, game in dirty.items():
+                self._dirty.setdefault(key, game)
+            raise
+
+    def close(self) -> None:
+        _, upserts, deletes = self._take_pending()
+        self._write(upserts, deletes)
+        with self._write_lock:
+            self._closed = True
+            self._conn.close()
+
+
+_EVENT_LOG_FILE = re.compile(r'(events|snapshot)-(\d+)\.jsonl?')
+
+def _game_to_row(chat_id, thread_id, game) -> list:
+    """把游戏序列化成快照中的一行"""
+    return [
+        chat_id, thread_id, game.host_id, game.host_name, game.game_start_time,
+        game.host_last_active, game.timer_state, game.last_roll_time,
+        [
+            [user_id, participant.full_name, participant.username, participant.message_id]
+            for user_id, participant in game.participants.items()
+        ],
+    ]
+
+def _game_from_row(row):
+    """_game_to_row 的逆操作，返回 (chat_id, thread_id, game)"""
+    (chat_id, thread_id, host_id, host_name, game_start_time,
+        host_last_active, timer_state, last_roll, participants) = row
+    game = Game(chat_id, host_id, host_name, game_start_time)
+    game.host_last_active = host_last_active
+    game.timer_state = timer_state
+    game.last_roll_time = last_roll
+    for user_id, full_name, username, message_id in participants:
+        game.add_participant(user_id, full_name, username, message_id)
+    return chat_id, thread_id, game
+
+def _apply_event(state, event) -> None:
+    """把一条事件应用到 {(chat_id, thread_id): Game} 上，重放日志时使用"""
+    kind, ts, chat_id, thread_id, *fields = event
+    key = (chat_id, thread_id)
+    if kind == 'create':
+        state[key] = Game(chat_id, fields[0], fields[1], ts)
+        return
+    game = state.get(key)
+    if game is None:
+        return
+    if kind == 'join':
+        game.add_participant(*fields)
+    elif kind in ('leave', 'kick'):
+        game.participants.pop(fields[0], None)
+    elif kind == 'touch':
+        game.host_last_active = ts
+        game.timer_state = 0
+    elif kind == 'timer':
+        game.timer_state = fields[0]
+    elif kind == 'roll':
+        game.last_roll_time = ts
+    elif kind in ('stop', 'adminstop', 'timeout'):
+        del state[key]
+
+
+class EventLogGameStore:
+    """只追加的事件日志存储
+
+    每次状态变化记成一条事件：[类型, 时间, chat_id, thread_id, 参数...]，
+    类型有 create/join/leave/kick/touch/roll/timer 以及结束游戏的 stop/adminstop/timeout；
+    roll 的参数是胜者、败者和每人的点数 [[user_id, 点数], ...]（较早的日志中没有点数）。
+    record_event() 只把事件放进内存缓冲区；flush() 在线程中序列化整批事件并追加到当前分段(events-N.jsonl)。
+    累计事件足够多（或距上次快照足够久）时，把所有进行中的游戏写成快照(snapshot-N.json)并切换到新分段，
+    快照之前的分段和旧快照随即删除（EVENT_LOG_ARCHIVE 时分段移入 archive/ 保留完整历史），
+    启动时加载最新快照，只重放其后的分段。
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._write_lock = threading.Lock()
+        self._pending = []  # 尚未写入的事件
+        self._file = None
+        self._file_segment = None
+        self._events_since_snapshot = 0
+        self._last_snapshot = time.monotonic()
+        self._closed = False
+        snapshots, segments = self._scan()
+        # 上次运行的最后一行可能只写了一半，新事件总是写入新的分段
+        self._segment = max(snapshots + segments, default=0) + 1
+
+    def _scan(self):
+        """返回目录中已有的快照编号和分段编号（均已排序）"""
+        snapshots, segments = [], []
+        for name in os.listdir(self._path):
+            match = _EVENT_LOG_FILE.fullmatch(name)
+            if match:
+                (snapshots if match[1] == 'snapshot' else segments).append(int(match[2]))
+        return sorted(snapshots), sorted(segments)
+
+    def _segment_path(self, number) -> str:
+        return os.path.join(self._path, f"events-{number:08d}.jsonl")
+
+    def _snapshot_path(self, number) -> str:
+        return os.path.join(self._path, f"snapshot-{number:08d}.json")
+
+    def load_games(self) -> list:
+        """加载最新快照并重放其后的事件，返回 [(chat_id, thread_id, game)]"""
+        snapshots, segments = self._scan()
+        state = {}
+        base = 0
+        if snapshots:
+            # 快照 N 包含分段 N 之前的全部事件
+            base = snapshots[-1]
+            with open(self._snapshot_path(base), encoding='utf-8') as f:
+                for row in json.load(f):
+                    chat_id, thread_id, game = _game_from_row(row)
+                    state[(chat_id, thread_id)] = game
+        replayed = 0
+        for number in segments:
+            if number < base:
+                continue
+            with open(self._segment_path(number), encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"事件日志 events-{number:08d}.jsonl 第 {line_number} 行不完整，已忽略")
+                        continue
+                    _apply_event(state, event)
+                    replayed += 1
+        # 重放的尾部计入下一次快照的阈值
+        self._events_since_snapshot = replayed
+        return [(chat_id, thread_id, game) for (chat_id, thread_id), game in state.items()]
+
+    def save_game(self, chat_id, thread_id, game) -> None:
+        pass  # 状态由事件重建
+
+    def delete_game(self, chat_id, thread_id) -> None:
+        pass
+
+    def record_event(self, kind, chat_id, thread_id, ts, *fields) -> None:
+        # 事件只包含不可变的基本类型，可以放心交给写入线程序列化
+        self._pending.append((kind, ts, chat_id, thread_id) + fields)
+
+    def _append(self, segment, events) -> None:
+        if not events:
+            return
+        data = ''.join(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n' for event in events)
+        with self._write_lock:
+            if self._closed:
+                return
+            if self._file_segment != segment:
+                self._close_segment()
+                self._file = open(self._segment_path(segment), 'a', encoding='utf-8')
+                self._file_segment = segment
+            size = os.fstat(self._file.fileno()).st_size
+            try:
+                self._file.write(data)
+                self._file.flush()
+                if EVENT_LOG_FSYNC:
+                    os.fsync(self._file.fileno())
+            except BaseException:
+                # 截掉可能只写了一部分的这批事件，整批由下次 flush 重试，重放时不会重复
+                self._discard_tail(segment, size)
+                raise
+
+    def _discard_tail(self, segment, size) -> None:
+        file, self._file, self._file_segment = self._file, None, None
+        try:
+            file.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self._segment_path(segment), size)
+        except OSError as e:
+            logging.error(f"事件日志 events-{segment:08d}.jsonl 截断失败: {e}")
+
+    def _close_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_segment = None
+
+    def _snapshot_rows(self) -> list:
+        """在事件循环里序列化所有游戏，快照对应取出待写事件这一刻的状态"""
+        rows = [_game_to_row(chat_id, thread_id, game) for (chat_id, thread_id), game in games.items()]
+        if spill_store is not None:
+            rows += spill_store.rows()
+        return rows
+
+    def _snapshot_written(self) -> None:
+        """快照写入成功，之后的事件写入新分段"""
+        self._segment += 1
+        self._events_since_snapshot = 0
+        self._last_snapshot = time.monotonic()
+
+    def _write_snapshot(self, rows, segment) -> None:
+        # 调用前当前分段已补齐，快照 segment+1 才与其之前的全部事件一致
+        with self._write_lock:
+            if self._closed:
+                return
+            self._close_segment()
+            path = self._snapshot_path(segment + 1)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(rows, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            # 新快照已经包含之前的所有事件，删除（或归档）旧分段和旧快照
+            snapshots, segments = self._scan()
+            for number in segments:
+                if number > segment:
+                    continue
+                if EVENT_LOG_ARCHIVE:
+                    archive = os.path.join(self._path, 'archive')
+                    os.makedirs(archive, exist_ok=True)
+                    os.replace(self._segment_path(number), os.path.join(archive, f"events-{number:08d}.jsonl"))
+                else:
+                    os.remove(self._segment_path(number))
+            for number in snapshots:
+                if number <= segment:
+                    os.remove(self._snapshot_path(number))
+
+    def _snapshot_due(self) -> bool:
+        count = self._events_since_snapshot + len(self._pending)
+        return count >= EVENT_LOG_SNAPSHOT_EVENTS or (
+            count > 0 and time.monotonic() - self._last_snapshot >= EVENT_LOG_SNAPSHOT_INTERVAL
+        )
+
+    async def flush(self) -> None:
+        snapshot = self._snapshot_due()
+        if not snapshot and not self._pending:
+            return
+        events, self._pending = self._pending, []
+        rows = self._snapshot_rows() if snapshot else None
+        try:
+            await asyncio.to_thread(self._append, self._segment, events)
+        except BaseException:
+            # 写入失败时把这批事件放回队首，保持顺序，下次 flush 整批重试
+            self._pending[:0] = events
+            raise
+        self._events_since_snapshot += len(events)
+        if snapshot:
+            # 快照写入失败时分段不变，事件照常追加到当前分段，下次 flush 重新做快照
+            await asyncio.to_thread(self._write_snapshot, rows, self._segment)
+            self._snapshot_written()
+
+    def close(self) -> None:
+        # 正常退出时做一次快照，下次启动不需要重放日志
+        if self._pending or self._events_since_snapshot:
+            events, self._pending = self._pending, []
+            rows = self._snapshot_rows()
+            self._append(self._segment, events)
+            self._write_snapshot(rows, self._segment)
+            self._snapshot_written()
+        with self._write_lock:
+            self._closed = True
+            self._close_segment()
+
+
+def _shard_path(path) -> str:
+    """多进程时每个工作进程使用自己的文件（games.db -> games-<编号>.db），避免多个进程争用同一个写锁"""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{shard[0]}{ext}"
+
+def _create_game_store():
+    if GAME_STORE == 'sqlite':
+        return SQLiteGameStore(_shard_path(GAME_DB_PATH))
+    if GAME_STORE == 'eventlog':
+        # 多进程时每个工作进程写自己的目录
+        path = EVENT_LOG_DIR if shard is None else os.path.join(EVENT_LOG_DIR, f"shard-{shard[0]}")
+        return EventLogGameStore(path)
+    if GAME_STORE != 'memory':
+        raise ValueError(f"错误: 未知的 GAME_STORE 类型 {GAME_STORE}，可选 memory、sqlite 或 eventlog")
+    return MemoryGameStore()
+
+game_store = MemoryGameStore()
+
+
+class GameSpillStore:
+    """闲置游戏的换出存储
+
+    换出时把游戏序列化成一行 JSON，内存中只保留 键 -> 计时堆条目序号，计时堆中的条目原样保留；
+    读回时恢复序号，计时提醒照常触发。写入和删除在 flush() 中批量进行，
+    尚未写入的行留在 _pending 中，读回时优先取用。换出的游戏只属于本次运行，启动时清空。
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")  # 只是内存的延伸，崩溃后不需要恢复
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spilled_games ("
+            " chat_id INTEGER NOT NULL,"
+            " thread_id INTEGER NOT NULL,"
+            " row TEXT NOT NULL,"
+            " PRIMARY KEY (chat_id, thread_id))"
+        )
+        self._conn.execute("DELETE FROM spilled_games")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.tokens = {}  # (chat_id, thread_id) -> 换出时的 timer_token
+        self._pending = {}  # 尚未写入的 (chat_id, thread_id) -> JSON
+        self._writing = {}  # 正在后台线程中写入的行
+        self._deleted = set()  # 已读回、待从磁盘删除的键
+
+    def spill(self, chat_id, thread_id, game) -> None:
+        key = (chat_id, thread_id)
+        self._pending[key] = json.dumps(_game_to_row(chat_id, thread_id, game), ensure_ascii=False)
+        self._deleted.discard(key)
+        self.tokens[key] = game.timer_token
+
+    def take(self, chat_id, thread_id):
+        """读回换出的游戏并从换出存储中移除，不存在时返回 None"""
+        key = (chat_id, thread_id)
+        token = self.tokens.pop(key, None)
+        if token is None:
+            return None
+        row = self._pending.pop(key, None) or self._writing.get(key)
+        if row is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT row FROM spilled_games WHERE chat_id = ? AND thread_id = ?", (chat_id, thread_id or 0)
+                ).fetchone()[0]
+        # 磁盘上可能有之前换出时写入的旧行
+        self._deleted.add(key)
+        game = _game_from_row(json.loads(row))[2]
+        game.timer_token = token
+        return game
+
+    def rows(self) -> list:
+        """所有换出游戏的快照行（供事件日志做快照）"""
+        with self._lock:
+            stored = dict(
+                ((chat_id, thread_id), row)
+                for chat_id, thread_id, row in self._conn.execute("SELECT chat_id, thread_id, row FROM spilled_games")
+            )
+        rows = []
+        for chat_id, thread_id in self.tokens:
+            key = (chat_id, thread_id)
+            row = self._pending.get(key) or self._writing.get(key) or stored.get((chat_id, thread_id or 0))
+            if row is not None:
+                rows.append(json.loads(row))
+        return rows
+
+    def _write(self, upserts, deletes) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            with self._conn:
+                if deletes:
+                    self._conn.executemany("DELETE FROM spilled_games WHERE chat_id = ? AND thread_id = ?", deletes)
+                if upserts:
+                    self._conn.executemany("INSERT OR REPLACE INTO spilled_games VALUES (?, ?, ?)", upserts)
+
+    async def flush(self) -> None:
+        if not self._pending and not self._deleted:
+            return
+        pending, self._pending = self._pending, {}
+        deleted, self._deleted = self._deleted, set()
+        upserts = [(chat_id, thread_id or 0, row) for (chat_id, thread_id), row in pending.items()]
+        deletes = [(chat_id, thread_id or 0) for chat_id, thread_id in deleted]
+        self._writing = pending
+        try:
+            await asyncio.to_thread(self._write, upserts, deletes)
+        except BaseException:
+            # 写入失败时放回仍处于换出状态的行，保证这些游戏仍能读回
+            for key, row in pending.items():
+                if key in self.tokens:
+                    self._pending.setdefault(key, row)
+            self._deleted |= deleted
+            raise
+        finally:
+            self._writing = {}
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._conn.close()
+
+spill_store = None  # 未启用换出时为 None
+
+def _create_spill_store():
+    if not GAME_SPILL_IDLE and not MAX_RESIDENT_GAMES:
+        return None
+    # 启动时会清空换出表，多进程时每个工作进程使用自己的文件
+    return GameSpillStore(_shard_path(GAME_SPILL_PATH))
+
+def restore_games(owns=None) -> int:
+    """从存储中恢复游戏（含冷却记录），并重新安排计时器，返回恢复的游戏数量
+
+    owns(chat_id) 返回 False 的游戏不恢复，多进程时每个工作进程只恢复分给自己的群组。
+    """
+    restored = game_store.load_games()
+    if owns is not None:
+        restored = [entry for entry in restored if owns(entry[0])]
+    for chat_id, thread_id, game in restored:
+        games[(chat_id, thread_id)] = game
+        _schedule_game_timer(chat_id, thread_id, game)
+        if game.last_roll_time is not None and ROLL_COOLDOWN > 0:
+            roll_cooldowns.consume((chat_id, thread_id), 1 / ROLL_COOLDOWN, 1, game.last_roll_time)
+    return len(restored)
+
+async def game_store_flusher(context: CallbackContext) -> None:
+    """定期把合并后的游戏变化批量写入存储"""
+    while True:
+        await asyncio.sleep(GAME_STORE_FLUSH_INTERVAL)
+        try:
+            await game_store.flush()
+        except Exception as e:
+            logging.error(f"游戏数据写入失败: {e}")
+
+async def close_stores(application: Application) -> None:
+    game_store.close()
+    stats_store.close()
+    if spill_store is not None:
+        spill_store.close()
+
+
+class PlayerStats:
+    """玩家在某个群组中的累计战绩"""
+    __slots__ = ('name', 'games', 'rolls', 'wins', 'losses', 'score_sum', 'last_game')
+
+    def __init__(self, name, games=0, rolls=0, wins=0, losses=0, score_sum=0, last_game=None):
+        self.name = name
+        self.games = games
+        self.rolls = rolls
+        self.wins = wins
+        self.losses = losses
+        self.score_sum = score_sum
+        self.last_game = last_game  # 最近一次参与的游戏（以开始时间标识），用于统计参与局数
+
+    @property
+    def average(self) -> float:
+        return self.score_sum / self.rolls if self.rolls else 0.0
+
+
+class ChatStats:
+    """一个群组的累计战绩
+
+    胜场榜和败场榜是 (-次数, user_id) 的有序列表，每次掷骰只移动胜者和败者两个条目，
+    查询排行榜和名次不需要扫描历史或全部玩家。
+    """
+    __slots__ = ('games', 'rolls', 'players', 'by_wins', 'by_losses', 'dirty')
+
+    def __init__(self, games=0, rolls=0, players=None):
+        self.games = games
+        self.rolls = rolls
+        self.players = players if players is not None else {}  # user_id -> PlayerStats
+        self.by_wins = sorted((-p.wins, user_id) for user_id, p in self.players.items() if p.wins)
+        self.by_losses = sorted((-p.losses, user_id) for user_id, p in self.players.items() if p.losses)
+        self.dirty = set()  # 有变化尚未写入的 user_id
+
+    @staticmethod
+    def _bump(board, user_id, count) -> None:
+        """把 user_id 在榜单上的次数从 count 改为 count + 1"""
+        if count:
+            del board[bisect.bisect_left(board, (-count, user_id))]
+        bisect.insort(board, (-count - 1, user_id))
+
+    @staticmethod
+    def rank(board, count) -> int:
+        """次数为 count 的玩家在榜单上的名次，同次数并列"""
+        return bisect.bisect_left(board, (-count,)) + 1
+
+    def record_roll(self, game, rolls, winner, loser) -> None:
+        """记入一次分出胜负的掷骰，开销与参与人数成正比；需在更新 game.last_roll_time 之前调用"""
+        if game.last_roll_time is None:  # 本局的第一次掷骰
+            self.games += 1
+        self.rolls += 1
+        players = self.players
+        participants = game.participants
+        game_id = game.game_start_time
+        for user_id, score in rolls.items():
+            player = players.get(user_id)
+            if player is None:
+                player = players[user_id] = PlayerStats(participants[user_id].full_name)
+            else:
+                player.name = participants[user_id].full_name
+            if player.last_game != game_id:
+                player.last_game = game_id
+                player.games += 1
+            player.rolls += 1
+            player.score_sum += score
+        self.dirty.update(rolls)
+        winner_stats, loser_stats = players[winner], players[loser]
+        self._bump(self.by_wins, winner, winner_stats.wins)
+        winner_stats.wins += 1
+        self._bump(self.by_losses, loser, loser_stats.losses)
+        loser_stats.losses += 1
+
+
+class StatsStore:
+    """群组战绩存储
+
+    内存中以 LRU 保存最近使用的 capacity 个群组；变化记在 dirty 中，flush() 在线程中批量写入 SQLite，
+    之后换出超出容量、没有未写入变化也没有进行中游戏的群组，下次用到时再从磁盘读回。
+    有进行中游戏的群组不会被换出，因此掷骰时更新的总是内存中的那一份。
+    path 为空时只保存在内存中，不写盘也不换出。
+    """
+
+    def __init__(self, path, capacity):
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_stats ("
+                " chat_id INTEGER PRIMARY KEY,"
+                " games INTEGER NOT NULL,"
+                " rolls INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS player_stats ("
+                " chat_id INTEGER NOT NULL,"
+                " user_id INTEGER NOT NULL,"
+                " name TEXT NOT NULL,"
+                " games INTEGER NOT NULL,"
+                " rolls INTEGER NOT NULL,"
+                " wins INTEGER NOT NULL,"
+                " losses INTEGER NOT NULL,"
+                " score_sum INTEGER NOT NULL,"
+                " last_game REAL,"
+                " PRIMARY KEY (chat_id, user_id))"
+            )
+            self._conn.commit()
+        self._capacity = capacity
+        self._lock = threading.Lock()  # 读写共用一个连接
+        self._closed = False
+        self.chats = OrderedDict()  # chat_id -> ChatStats，按最近使用排序
+        self._dirty = set()  # 有未写入变化的 chat_id
+        self.evictions = 0
+
+    def _read(self, chat_id) -> ChatStats:
+        if self._conn is None:
+            return ChatStats()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT games, rolls FROM chat_stats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            players = {
+                user_id: PlayerStats(*fields)
+                for user_id, *fields in self._conn.execute(
+                    "SELECT user_id, name, games, rolls, wins, losses, score_sum, last_game"
+                    " FROM player_stats WHERE chat_id = ?", (chat_id,)
+                )
+            }
+        return ChatStats(*(row or (0, 0)), players)
+
+    def get(self, chat_id) -> ChatStats:
+        """获取群组战绩，不在内存中时从磁盘读入
+
+        按主键范围读取一个群组通常不到 1 毫秒，直接在事件循环里读比切换到线程池等待更快。
+        """
+        stats = self.chats.get(chat_id)
+        if stats is None:
+            stats = self.chats[chat_id] = self._read(chat_id)
+        else:
+            self.chats.move_to_end(chat_id)
+        return stats
+
+    def record_roll(self, chat_id, game, rolls, winner, loser) -> None:
+        self.get(chat_id).record_roll(game, rolls, winner, loser)
+        self._dirty.add(chat_id)
+
+    def _take_pending(self):
+        """在事件循环里把有变化的战绩序列化成行，同时返回取出的 chat_id -> 有变化的 user_id"""
+        dirty, self._dirty = self._dirty, set()
+        taken = {}
+        chat_rows, player_rows = [], []
+        for chat_id in dirty:
+            stats = self.chats[chat_id]
+            chat_rows.append((chat_id, stats.games, stats.rolls))
+            players = stats.players
+            for user_id in stats.dirty:
+                p = players[user_id]
+                player_rows.append(
+                    (chat_id, user_id, p.name, p.games, p.rolls, p.wins, p.losses, p.score_sum, p.last_game)
+                )
+            taken[chat_id], stats.dirty = stats.dirty, set()
+        return taken, chat_rows, player_rows
+
+    def _write(self, chat_rows, player_rows) -> None:
+        with self._lock:
+            if self._closed or self._conn is None:
+                return
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO chat_stats VALUES (?, ?, ?)", chat_rows)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO player_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", player_rows
+                )
+
+    def _evict(self) -> None:
+        """换出超出容量的最久未用群组，有未写入变化或有进行中游戏的群组保留"""
+        if self._conn is None or len(self.chats) <= self._capacity:
+            return
+        active = {chat_id for chat_id, _ in games}
+        for chat_id in list(self.chats):
+            if len(self.chats) <= self._capacity:
+                break
+            if chat_id not in self._dirty and chat_id not in active:
+                del self.chats[chat_id]
+                self.evictions += 1
+
+    async def flush(self) -> None:
+        if self._dirty:
+            taken, chat_rows, player_rows = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write, chat_rows, player_rows)
+            except BaseException:
+                # 写入失败时恢复未写入标记：这些群组不会被换出（内存中是唯一的一份），下次 flush 重试
+                for chat_id, user_ids in taken.items():
+                    self._dirty.add(chat_id)
+                    self.chats[chat_id].dirty |= user_ids
+                raise
+        self._evict()
+
+    def close(self) -> None:
+        _, chat_rows, player_rows = self._take_pending()
+        self._write(chat_rows, player_rows)
+        with self._lock:
+            self._closed = True
+            if self._conn is not None:
+                self._conn.close()
+
+stats_store = StatsStore(None, STATS_CACHE_SIZE)
+
+async def stats_flusher(context: CallbackContext) -> None:
+    """定期写入战绩变化并换出不活跃的群组"""
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            await stats_store.flush()
+        except Exception as e:
+            logging.error(f"战绩写入失败: {e}")
+
+
+def runtime_gauges() -> dict:
+    """抓取时计算的瞬时指标，未启用 METRICS_ENABLED 时 /stats 也会用到"""
+    return {
+        'tod_active_games': len(games) + (len(spill_store.tokens) if spill_store is not None else 0),
+        'tod_resident_games': len(games),
+        'tod_active_participants': sum(len(game.participants) for game in games.values()),
+        'tod_message_queue_depth': message_queue.qsize(),
+        'tod_timer_queue_depth': timer_queue.qsize(),
+        'tod_timer_heap_size': len(timer_heap),
+        'tod_throttled_chats': sum(1 for s in chat_send_states.values() if s.blocked_until > time.monotonic()),
+        'tod_admin_cache_hits': admin_cache.hits,
+        'tod_admin_cache_misses': admin_cache.misses,
+        'tod_pending_messages': pending_sends,
+        'tod_send_lag_seconds': round(sender_lag, 3),
+        'tod_healthy': int(health_status()['ok']),
+    }
+
+class Histogram:
+    """固定分桶的直方图（Prometheus 累积桶格式）"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        """按分桶估算分位数（返回所在桶的上界）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """运行指标：计数器和直方图在热路径上记录，游戏数、队列长度等在抓取时才计算"""
+
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    HELP = {
+        'tod_command_duration_seconds': ('histogram', '命令处理耗时'),
+        'tod_game_lock_wait_seconds': ('histogram', '获取游戏锁的等待时间'),
+        'tod_send_rate_limit_delay_seconds': ('histogram', '消息因限速被推迟的时间'),
+        'tod_messages_sent_total': ('counter', '发送成功的消息数'),
+        'tod_message_send_failures_total': ('counter', '发送失败的次数'),
+        'tod_timer_actions_total': ('counter', '触发的定时提醒和超时结束次数'),
+        'tod_commands_throttled_total': ('counter', '因超过频率限制被丢弃的命令数'),
+        'tod_background_restarts_total': ('counter', '后台循环异常退出后被重启的次数'),
+    }
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> 数值
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, name, labels=(), value=1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()) -> None:
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.LATENCY_BUCKETS)
+        histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for name, value in runtime_gauges().items():
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+
+        described = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in described:
+                described.add(name)
+                lines += [f'# HELP {name} {self.HELP[name][1]}', f'# TYPE {name} counter']
+            lines.append(f'{name}{self._labels(labels)} {value}')
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in described:
+                described.add(name)
+                lines += [f'# HELP {name} {self.HELP[name][1]}', f'# TYPE {name} histogram']
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+# 未启用时为 None，各记录点只多一次 is None 判断
+metrics = Metrics() if METRICS_ENABLED else None
+
+def instrumented(command, handler):
+    """启用指标时给命令处理函数包一层计时，未启用时原样返回"""
+    if metrics is None:
+        return handler
+    labels = (('command', command),)
+
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        finally:
+            metrics.observe('tod_command_duration_seconds', time.perf_counter() - started, labels)
+
+    return wrapper
+
+async def _handle_metrics_request(reader, writer) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # 读完请求头
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode(errors='replace').split()
+        path = parts[1] if len(parts) > 1 else '/'
+        if path == '/metrics':
+            status, body = '200 OK', metrics.render()
+        elif path == '/healthz':
+            health = health_status()
+            status = '200 OK' if health['ok'] else '503 Service Unavailable'
+            body = json.dumps(health, ensure_ascii=False) + '\n'
+        else:
+            status, body = '404 Not Found', 'not found\n'
+        payload = body.encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def metrics_server(context: CallbackContext) -> None:
+    """在本地提供 Prometheus 文本格式的 /metrics 和 JSON 格式的 /healthz（不健康时返回 503）"""
+    # 多进程时每个工作进程各自提供指标，端口依次为 METRICS_PORT + 分片序号
+    port = METRICS_PORT + (shard[0] if shard else 0)
+    server = await asyncio.start_server(_handle_metrics_request, METRICS_LISTEN, port)
+    async with server:
+        await server.serve_forever()
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/stats：运行状态摘要，仅 BOT_ADMIN_IDS 中的用户可用"""
+    if update.effective_user.id not in BOT_ADMIN_IDS:
+        send_reply(update, "只有 bot 管理员可以使用 /stats。")
+        return
+
+    gauges = runtime_gauges()
+    lines = [
+        "📊 运行状态",
+        f"进行中的游戏: {gauges['tod_active_games']}（内存中 {gauges['tod_resident_games']}）",
+        f"参与玩家: {gauges['tod_active_participants']}",
+        f"发送队列: {gauges['tod_message_queue_depth']}，定时队列: {gauges['tod_timer_queue_depth']}",
+        f"被限流的聊天: {gauges['tod_throttled_chats']}",
+        f"管理员缓存命中/未命中: {gauges['tod_admin_cache_hits']}/{gauges['tod_admin_cache_misses']}",
+        f"待发消息: {gauges['tod_pending_messages']}，最近排队时长: {gauges['tod_send_lag_seconds']:g} 秒",
+    ]
+    health = health_status()
+    lines.append("健康状况: 正常" if health['ok'] else "健康状况: " + "；".join(health['problems']))
+    if metrics is None:
+        lines.append("（未启用 METRICS_ENABLED，没有延迟和发送统计）")
+    else:
+        sent = sum(v for (name, _), v in metrics.counters.items() if name == 'tod_messages_sent_total')
+        failed = sum(v for (name, _), v in metrics.counters.items() if name == 'tod_message_send_failures_total')
+        timers = sum(v for (name, _), v in metrics.counters.items() if name == 'tod_timer_actions_total')
+        lines.append(f"发送成功/失败: {sent}/{failed}，定时动作: {timers}")
+        for (name, labels), histogram in sorted(metrics.histograms.items()):
+            if name == 'tod_command_duration_seconds':
+                lines.append(
+                    f"/{labels[0][1]}: {histogram.count} 次，"
+                    f"p50≤{histogram.quantile(0.5) * 1000:g}ms p95≤{histogram.quantile(0.95) * 1000:g}ms"
+                )
+        lock_wait = metrics.histograms.get(('tod_game_lock_wait_seconds', ()))
+        if lock_wait is not None:
+            lines.append(f"游戏锁等待 p95≤{lock_wait.quantile(0.95) * 1000:g}ms")
+    send_reply(update, "\n".join(lines))
+
+
+def _format_board(stats, board, label) -> list:
+    lines = []
+    for rank, (count, user_id) in enumerate(board[:STATS_TOP_K], 1):
+        player = stats.players[user_id]
+        lines.append(f"{rank}. {player.name}：{label} {-count} 次（掷骰 {player.rolls} 次，平均 {player.average:.1f} 点）")
+    return lines or ["暂无"]
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/top：本群失败和胜利次数最多的玩家"""
+    chat = update.effective_chat
+    if chat.type == 'private':
+        send_reply(update, "请在群组中使用 /top 查看本群排行榜。")
+        return
+
+    stats = stats_store.get(chat.id)
+    if not stats.rolls:
+        send_reply(update, "本群还没有掷骰记录。")
+        return
+    lines = [f"🏅 本群排行榜（共 {stats.games} 局游戏，{stats.rolls} 次掷骰）", "", "😵 失败次数最多："]
+    lines += _format_board(stats, stats.by_losses, "失败")
+    lines += ["", "🏆 胜利次数最多："]
+    lines += _format_board(stats, stats.by_wins, "胜利")
+    send_reply(update, "\n".join(lines))
+
+async def mystats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/mystats：自己在本群的战绩和名次"""
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat.type == 'private':
+        send_reply(update, "请在群组中使用 /mystats 查看自己在本群的战绩。")
+        return
+
+    stats = stats_store.get(chat.id)
+    player = stats.players.get(user.id)
+    if player is None:
+        send_reply(update, "您在本群还没有掷骰记录。")
+        return
+    wins = f"胜利: {player.wins} 次"
+    if player.wins:
+        wins += f"（第 {stats.rank(stats.by_wins, player.wins)} 名）"
+    losses = f"失败: {player.losses} 次"
+    if player.losses:
+        losses += f"（第 {stats.rank(stats.by_losses, player.losses)} 名）"
+    send_reply(update, "\n".join([
+        f"📈 {user.full_name} 在本群的战绩",
+        f"参与游戏: {player.games} 局，掷骰 {player.rolls} 次",
+        wins,
+        losses,
+        f"平均点数: {player.average:.1f}",
+    ]))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text('欢迎使用真心话大冒险 Bot！使用 /createnewgame 开始游戏。')
+    send_reply(update, '欢迎使用真心话大冒险 Bot！使用 /createnewgame 开始游戏。')
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     help_text = (
@@ -48,6 +1273,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/join - 加入当前游戏\n"
         "/leave - 离开当前游戏\n"
         "/roll - 投骰子 (仅主持人)\n"
+        "/top - 本群排行榜\n"
+        "/mystats - 我在本群的战绩\n"
         "/help - 显示帮助消息\n\n"
         "注意：\n"
         "- 只有主持人可以开始、结束游戏，进行 /roll 投掷骰子。\n"
@@ -56,7 +1283,220 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "- 如果无法由主持人结束游戏时，群内管理可以用 /adminstop 结束游戏。\n"
         "- Bot需要管理员权限中的「删除消息」权限，以正确识别群内成员并管理游戏。"
     )
-    await update.message.reply_text(help_text)
+    send_reply(update, help_text)
+
+def _get_game(chat_id, thread_id):
+    """返回进行中的游戏，已换出的闲置游戏会被读回内存，调用方需持有该游戏的锁"""
+    game = games.get((chat_id, thread_id))
+    if game is None and spill_store is not None:
+        game = spill_store.take(chat_id, thread_id)
+        if game is not None:
+            games[(chat_id, thread_id)] = game
+    return game
+
+def _drop_game(chat_id, thread_id, reason) -> None:
+    """删除游戏数据（冷却记录随游戏一起删除），reason 为 stop/adminstop/timeout，调用方需持有该游戏的锁"""
+    global _stale_timers
+    game = games.pop((chat_id, thread_id), None)
+    if game is not None:
+        if game.timer_token is not None:
+            _stale_timers += 1
+        game_store.delete_game(chat_id, thread_id)
+        game_store.record_event(reason, chat_id, thread_id, time.time())
+        if LOBBY_MODE:
+            _close_lobby(chat_id, thread_id, game, _LOBBY_CLOSED[reason])
+    roll_cooldowns.discard((chat_id, thread_id))
+
+def _schedule_game_timer(chat_id, thread_id, game) -> None:
+    """按游戏当前的计时阶段计算下一个截止时间并放入最小堆"""
+    global _stale_timers
+    if game.timer_token is not None:
+        _stale_timers += 1
+    delay, _, _ = TIMER_STAGES[game.timer_state]
+    deadline = game.host_last_active + delay
+    seq = next(_timer_seq)
+    game.timer_token = seq
+    heapq.heappush(timer_heap, (deadline, seq, chat_id, thread_id))
+
+    # 过期条目过多时整体重建，避免频繁 /roll 让堆无限增长
+    if _stale_timers > 1024 and _stale_timers * 2 > len(timer_heap):
+        _compact_timer_heap()
+
+    # 新条目成为最早的截止时间时唤醒调度器
+    if timer_heap[0][1] == seq:
+        timer_wakeup.set()
+
+def _compact_timer_heap() -> None:
+    global _stale_timers
+    spilled = spill_store.tokens if spill_store is not None else {}
+    timer_heap[:] = [
+        entry for entry in timer_heap
+        if ((game := games.get((entry[2], entry[3]))) is not None and game.timer_token == entry[1])
+        or spilled.get((entry[2], entry[3])) == entry[1]
+    ]
+    heapq.heapify(timer_heap)
+    _stale_timers = 0
+
+def _touch_host(chat_id, thread_id, game, current_time) -> None:
+    """主持人有操作：更新最后活跃时间、重置计时状态并重新安排截止时间"""
+    game.host_last_active = current_time
+    game.timer_state = 0  # 重置计时状态
+    _schedule_game_timer(chat_id, thread_id, game)
+    game_store.save_game(chat_id, thread_id, game)
+    game_store.record_event('touch', chat_id, thread_id, current_time)
+    if LOBBY_MODE:
+        # 大厅消息上的计时提醒或上一局的加赛情况已过时
+        lobby = lobbies.get((chat_id, thread_id))
+        if lobby is not None and lobby.status is not None:
+            _lobby_changed(chat_id, thread_id, None)
+
+
+class Lobby:
+    """大厅消息的发送状态
+
+    message_id 在第一次发送完成后才知道；同一时刻最多一个发送或编辑在队列中，
+    期间的变化只标记 dirty，完成后再合并成一次编辑。
+    """
+    __slots__ = ('message_id', 'status', 'dirty', 'sending', 'handle', 'closed_text')
+
+    def __init__(self):
+        self.message_id = None
+        self.status = None  # 参与者列表下方的一行：计时提醒或加赛情况
+        self.dirty = False
+        self.sending = False
+        self.handle = None  # 等待中的延迟编辑
+        self.closed_text = None  # 游戏结束后的最终内容
+
+_LOBBY_KEEP = object()
+_LOBBY_NO_USERNAME = " ⚠️"
+_LOBBY_CLOSED = {
+    'stop': "游戏已由主持人结束。",
+    'adminstop': "管理员已结束游戏。",
+    'timeout': TIMER_STAGES[20][2],
+}
+
+def _render_lobby(game, status, closed=False) -> str:
+    """大厅消息的内容：主持人、参与者列表（超长时截断）、状态行和操作提示"""
+    title = "🎲 本局游戏已结束" if closed else "🎲 真心话大冒险进行中"
+    head = [f"{title}（主持人：{html.escape(game.host_name)}）", "", f"玩家（{len(game.participants)}人）："]
+    tail = []
+    if any(not participant.username for participant in game.participants.values()):
+        tail.append(f"{_LOBBY_NO_USERNAME.strip()} 标记的玩家没有设置用户名，bot 无法@提醒，请自行注意游戏结果。")
+    if status:
+        tail += ["", html.escape(status)]
+    if not closed:
+        tail += ["", "使用 /join 加入、/leave 离开；主持人 /roll 掷骰、/stop 结束游戏。"]
+
+    budget = MAX_MESSAGE_LENGTH - sum(_visible_length(line) + 1 for line in head + tail) - 40
+    lines = [] if game.participants else ["还没有人加入"]
+    for i, participant in enumerate(game.participants.values()):
+        line = participant.display if participant.username else participant.display + _LOBBY_NO_USERNAME
+        budget -= participant.display_length + len(_LOBBY_NO_USERNAME) + 1
+        if budget < 0:
+            lines.append(f"…… 另有 {len(game.participants) - i} 人")
+            break
+        lines.append(line)
+    return "\n".join(head + lines + tail)
+
+def _lobby_changed(chat_id, thread_id, status=_LOBBY_KEEP) -> None:
+    """游戏状态有变化，LOBBY_EDIT_DELAY 秒后编辑大厅消息；期间的变化合并为一次编辑"""
+    key = (chat_id, thread_id)
+    lobby = lobbies.get(key)
+    if lobby is None:
+        # 重启恢复的游戏没有大厅消息，第一次变化时重新发送
+        lobby = lobbies[key] = Lobby()
+    if status is not _LOBBY_KEEP:
+        lobby.status = status
+    lobby.dirty = True
+    if lobby.handle is None and not lobby.sending:
+        lobby.handle = asyncio.get_running_loop().call_later(LOBBY_EDIT_DELAY, _flush_lobby, key)
+
+def _flush_lobby(key, reply_to=None) -> None:
+    """把大厅消息的最新内容交给发送器：还没有消息时发送新消息，否则编辑
+
+    由 call_later 调用，不持有游戏的锁，所以只读取内存中的游戏：已换出的游戏保留待编辑状态，
+    读回后的下一次变化会重新安排编辑
+    """
+    lobby = lobbies.get(key)
+    if lobby is None:
+        return
+    if lobby.handle is not None:
+        lobby.handle.cancel()
+        lobby.handle = None
+    if not lobby.dirty or lobby.sending:
+        return
+    game = games.get(key)
+    if game is None:
+        if spill_store is None or key not in spill_store.tokens:
+            del lobbies[key]
+        return
+    lobby.dirty = False
+    lobby.sending = True
+    enqueue_message(
+        key[0], key[1], _render_lobby(game, lobby.status), parse_mode='HTML', reply_to=reply_to,
+        edit_message_id=lobby.message_id, on_sent=lambda result: _lobby_sent(key, lobby, result)
+    )
+
+def _lobby_sent(key, lobby, result) -> None:
+    """发送或编辑完成（失败时 result 为 None）：记录消息 ID，期间又有变化则继续编辑
+
+    编辑失败（原消息被删除等）时 _deliver 会改发一条新消息，这里换成新消息的 ID，之后编辑它
+    """
+    lobby.sending = False
+    if result is not None and result is not True:
+        lobby.message_id = result.message_id
+    if lobby.closed_text is not None:
+        if lobby.message_id is not None:
+            enqueue_message(key[0], key[1], lobby.closed_text, parse_mode='HTML', edit_message_id=lobby.message_id)
+        return
+    if lobby.dirty and lobby.handle is None:
+        lobby.handle = asyncio.get_running_loop().call_later(LOBBY_EDIT_DELAY, _flush_lobby, key)
+
+def _close_lobby(chat_id, thread_id, game, status) -> None:
+    """游戏结束：大厅消息改为最终的玩家列表和结束原因，之后不再编辑"""
+    lobby = lobbies.pop((chat_id, thread_id), None)
+    if lobby is None:
+        return
+    if lobby.handle is not None:
+        lobby.handle.cancel()
+        lobby.handle = None
+    lobby.closed_text = _render_lobby(game, status, closed=True)
+    # 消息还在发送中时由 _lobby_sent 在拿到消息 ID 后编辑
+    if not lobby.sending and lobby.message_id is not None:
+        enqueue_message(chat_id, thread_id, lobby.closed_text, parse_mode='HTML', edit_message_id=lobby.message_id)
+
+def flush_lobbies() -> int:
+    """立即提交所有等待中的延迟编辑（退出前调用），返回提交的数量"""
+    keys = [key for key, lobby in lobbies.items() if lobby.handle is not None]
+    for key in keys:
+        _flush_lobby(key)
+    return len(keys)
+
+@asynccontextmanager
+async def game_lock(chat_id, thread_id):
+    """获取单个游戏的锁
+
+    锁在首次使用时创建，游戏不存在时在释放时一并清理。
+    如果等待期间锁已被清理（游戏被结束），则重新获取新锁，保证同一游戏同一时刻只有一个持有者。
+    """
+    key = (chat_id, thread_id)
+    started = time.perf_counter() if metrics is not None else 0.0
+    while True:
+        lock = game_locks.get(key)
+        if lock is None:
+            lock = game_locks[key] = Lock()
+        async with lock:
+            if game_locks.get(key) is not lock:
+                continue
+            if metrics is not None:
+                metrics.observe('tod_game_lock_wait_seconds', time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                if key not in games and game_locks.get(key) is lock:
+                    del game_locks[key]
+            return
+
 
 async def create_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
@@ -64,95 +1504,82 @@ async def create_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     thread_id = getattr(update.message, "message_thread_id", 0)  # 兼容话题群组
     current_time = time.time()
     
-    async with games_lock:
-        if chat_id in games and thread_id in games[chat_id]:
-            host_name = games[chat_id][thread_id]['host'].full_name
-            host_id = games[chat_id][thread_id]['host'].id
-            await update.message.reply_text(f'群里已经有一个由（{host_name}：{host_id}）主持的游戏啦。')
+    # 持锁期间只修改状态，回复在释放锁之后发送
+    async with game_lock(chat_id, thread_id):
+        game = _get_game(chat_id, thread_id)
+        if game is not None:
+            reply = f'群里已经有一个由（{game.host_name}：{game.host_id}）主持的游戏啦。'
         else:
-            if chat_id not in games:
-                games[chat_id] = {}
-            
-            # 添加游戏计时器相关字段
-            games[chat_id][thread_id] = {
-                'participants': set(),
-                'host': user,
-                'participant_info': {},
-                'game_start_time': current_time,
-                'host_last_active': current_time,
-                'timer_state': 0
-            }
-            await update.message.reply_text('新游戏已创建！使用 /join 加入游戏。\n开始游戏的人会充当主持人，负责本局游戏的管理。\n当不能负责时，请及时 /stop 结束游戏。')
+            game = games[(chat_id, thread_id)] = Game(chat_id, user.id, user.full_name, current_time)
+            _schedule_game_timer(chat_id, thread_id, game)
+            game_store.save_game(chat_id, thread_id, game)
+            game_store.record_event('create', chat_id, thread_id, current_time, user.id, user.full_name)
+            reply = '新游戏已创建！使用 /join 加入游戏。\n开始游戏的人会充当主持人，负责本局游戏的管理。\n当不能负责时，请及时 /stop 结束游戏。'
+            if LOBBY_MODE:
+                # 大厅消息代替创建成功的回复，之后的加入、离开和提醒都编辑这条消息
+                lobby = lobbies[(chat_id, thread_id)] = Lobby()
+                lobby.dirty = True
+                _flush_lobby((chat_id, thread_id), reply_to=update.message.message_id)
+                reply = None
+
+    if reply is not None:
+        send_reply(update, reply)
 
 async def stop_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     thread_id = getattr(update.message, "message_thread_id", 0)
     user = update.effective_user
 
-    async with games_lock:
+    async with game_lock(chat_id, thread_id):
+        game = _get_game(chat_id, thread_id)
+
         # 1. 检查游戏是否存在
-        if chat_id not in games or thread_id not in games[chat_id]:
-            await update.message.reply_text('当前没有进行中的游戏。')
-            return
+        if game is None:
+            reply = '当前没有进行中的游戏。'
 
         # 2. 检查用户权限
-        game = games[chat_id][thread_id]
-        if user.id != game['host'].id:
-            host_name = game['host'].full_name
-            host_id = game['host'].id
-            await update.message.reply_text(f'只有本次游戏的主持人（{host_name}：{host_id}）可以结束游戏。\n 如果TA这会儿不在，可呼叫群管理结束游戏')
-            return
+        elif user.id != game.host_id:
+            reply = f'只有本次游戏的主持人（{game.host_name}：{game.host_id}）可以结束游戏。\n 如果TA这会儿不在，可呼叫群管理结束游戏'
 
         # 3. 删除游戏数据
-        del games[chat_id][thread_id]
-        if not games[chat_id]:  
-            del games[chat_id]
-        await update.message.reply_text('游戏已结束。')
+        else:
+            _drop_game(chat_id, thread_id, 'stop')
+            reply = '游戏已结束。'
 
-    async with last_roll_lock:
-        if chat_id in last_roll_time and thread_id in last_roll_time[chat_id]:
-            del last_roll_time[chat_id][thread_id]
-            if not last_roll_time[chat_id]:
-                del last_roll_time[chat_id]
+    send_reply(update, reply)
 
 async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     thread_id = getattr(update.message, "message_thread_id", 0)
     user = update.effective_user
     message_id = update.message.message_id
+    replies = []
 
-    async with games_lock:
-        if chat_id in games and thread_id in games[chat_id]:
-            game = games[chat_id][thread_id]
-
-            if "participants" not in game:
-                game["participants"] = set()
-            if "participant_info" not in game:
-                game["participant_info"] = {}
-
-            if user.id in game["participants"]:
-                await update.message.reply_text(f"{user.full_name} 已经在游戏中。")
+    async with game_lock(chat_id, thread_id):
+        game = _get_game(chat_id, thread_id)
+        if game is not None:
+            if user.id in game.participants:
+                if not LOBBY_MODE:
+                    replies.append(f"{user.full_name} 已经在游戏中。")
             else:
-                chat_id_for_link = chat_id
-                if isinstance(chat_id_for_link, int) and chat_id_for_link < 0:
-                    chat_id_str = str(chat_id_for_link)[4:]  # 处理超级群ID
+                game.add_participant(user.id, user.full_name, user.username, message_id)
+                game_store.save_game(chat_id, thread_id, game)
+                game_store.record_event(
+                    'join', chat_id, thread_id, time.time(), user.id, user.full_name, user.username, message_id
+                )
+                if LOBBY_MODE:
+                    # 不单独回复，连续加入合并成一次大厅消息编辑（没有用户名的玩家在列表中标记）
+                    _lobby_changed(chat_id, thread_id)
                 else:
-                    chat_id_str = str(chat_id_for_link)
-                message_link = f"https://t.me/c/{chat_id_str}/{message_id}"
-
-                host_name = games[chat_id][thread_id]['host'].full_name
-                game["participants"].add(user.id)
-                game["participant_info"][user.id] = {
-                    "full_name": user.full_name,
-                    "username": user.username,
-                    "join_message_link": message_link
-                }
-                await update.message.reply_text(f"{user.full_name} 已加入由（{host_name}）主持的游戏。")
-                if not user.username:
-                    await update.message.reply_text("您的账号没有设置用户名，根据TG的规则 bot 将无法在游戏中对您做出@提醒，请自行注意游戏结果。")
+                    replies.append(f"{user.full_name} 已加入由（{game.host_name}）主持的游戏。")
+                    if not user.username:
+                        replies.append("您的账号没有设置用户名，根据TG的规则 bot 将无法在游戏中对您做出@提醒，请自行注意游戏结果。")
 
         else:
-            await update.message.reply_text("当前没有进行中的游戏。使用 /createnewgame 开始一个新游戏。\n开始游戏的人会充当主持人，负责本局游戏的管理。\n当不能负责时，请及时 /stop 结束游戏。")
+            replies.append("当前没有进行中的游戏。使用 /createnewgame 开始一个新游戏。\n开始游戏的人会充当主持人，负责本局游戏的管理。\n当不能负责时，请及时 /stop 结束游戏。")
+
+    for reply in replies:
+        send_reply(update, reply)
 
 
 async def leave_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -161,330 +1588,1204 @@ async def leave_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     thread_id = getattr(update.message, "message_thread_id", 0)
     replied_message = update.message.reply_to_message  # 获取被回复的消息
 
-    async with games_lock:
-        if chat_id not in games or thread_id not in games[chat_id]:
-            await update.message.reply_text('当前没有进行中的游戏。')
-            return
-        
-        game = games[chat_id][thread_id]
-        host_id = game['host'].id
-
-        # 主持人通过回复他人消息踢人
-        if user.id == host_id and replied_message:
-            target_user = replied_message.from_user
-            if target_user.id == host_id:
-                await update.message.reply_text("主持人不能自己移除自己。")
-                return
+    async with game_lock(chat_id, thread_id):
+        reply = _leave_game_locked(chat_id, thread_id, user, replied_message, time.time())
 
-            if target_user.id in game['participants']:
-                host_name = games[chat_id][thread_id]['host'].full_name
-                game['participants'].remove(target_user.id)
-                del game['participant_info'][target_user.id]
-                await update.message.reply_text(
-                    f"主持人（{host_name}）已将 {target_user.full_name} 移出游戏。"
-                )
-                return
-            else:
-                await update.message.reply_text("该用户不在游戏中。")
-                return
+    if reply is not None:
+        send_reply(update, reply)
 
-        # 普通用户自己离开
-        if user.id != host_id:
-            if user.id in game['participants']:
-                game['participants'].remove(user.id)
-                del game['participant_info'][user.id]
-                await update.message.reply_text(f'{user.full_name} 已离开游戏。')
-            else:
-                await update.message.reply_text('您不在游戏中。')
-            return
+def _leave_game_locked(chat_id, thread_id, user, replied_message, current_time):
+    """处理 /leave 的状态变更并返回回复内容（大厅消息模式下离开成功时为 None，改为编辑大厅消息），调用方需持有该游戏的锁"""
+    game = _get_game(chat_id, thread_id)
+    if game is None:
+        return '当前没有进行中的游戏。'
 
-        # 主持人单独发送/leave
-        await update.message.reply_text(
-            '您作为游戏主持人无法离开游戏，'
-            '如果需要更换主持人请先（/stop）结束游戏，'
-            '再由新主持人（/createnewgame）开始游戏'
-        )
+    host_id = game.host_id
+
+    # 主持人通过回复他人消息踢人
+    if user.id == host_id and replied_message:
+        target_user = replied_message.from_user
+        if target_user.id == host_id:
+            return "主持人不能自己移除自己。"
+
+        if target_user.id in game.participants:
+            _touch_host(chat_id, thread_id, game, current_time)
+            del game.participants[target_user.id]
+            game_store.save_game(chat_id, thread_id, game)
+            game_store.record_event('kick', chat_id, thread_id, current_time, target_user.id)
+            if LOBBY_MODE:
+                _lobby_changed(chat_id, thread_id)
+                return None
+            return f"主持人（{game.host_name}）已将 {target_user.full_name} 移出游戏。"
+        else:
+            return "该用户不在游戏中。"
+
+    # 普通用户自己离开
+    if user.id != host_id:
+        if user.id in game.participants:
+            del game.participants[user.id]
+            game_store.save_game(chat_id, thread_id, game)
+            game_store.record_event('leave', chat_id, thread_id, current_time, user.id)
+            if LOBBY_MODE:
+                _lobby_changed(chat_id, thread_id)
+                return None
+            return f'{user.full_name} 已离开游戏。'
+        else:
+            return '您不在游戏中。'
+
+    # 主持人单独发送/leave
+    return (
+        '您作为游戏主持人无法离开游戏，'
+        '如果需要更换主持人请先（/stop）结束游戏，'
+        '再由新主持人（/createnewgame）开始游戏'
+    )
         
 async def roll_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     user = update.effective_user
     thread_id = getattr(update.message, "message_thread_id", 0)
     current_time = time.time()
-    retry_count = 0
-    max_retries = 5   
+
+    # 平局加赛在内存中一次完成，持锁期间不发送消息也不等待
+    async with game_lock(chat_id, thread_id):
+        texts, parse_mode = _roll_dice_locked(chat_id, thread_id, user, current_time)
+
+    # 结果超长时分成多条，同一聊天的消息按入队顺序发送
+    for text in texts:
+        send_reply(update, text, parse_mode=parse_mode)
+
+_HTML_TAG = re.compile(r'<[^>]*>')
+
+def _visible_length(text) -> int:
+    """HTML 文本在 Telegram 中的长度：不计标签，实体按一个字符，emoji 等非 BMP 字符占两个 UTF-16 码元"""
+    if '<' in text:
+        text = _HTML_TAG.sub('', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return len(text.encode('utf-16-le')) // 2
+
+def _measured(text):
+    return text, _visible_length(text)
+
+def _pack(items, limit, sep="\n"):
+    """按顺序把 (文本, 显示长度) 用 sep 连接成若干段，每段长度不超过 limit
+
+    只在 item 之间断开，每个 item 内的 HTML 标签都是完整的，因此不会截断标签；
+    空文本表示段落间的空行，落在段首时省略。
+    """
+    sep_length = _visible_length(sep)
+    chunk, size = [], 0
+    for item, length in items:
+        if not item and not chunk:
+            continue
+        if chunk and size + sep_length + length > limit:
+            yield sep.join(chunk)
+            chunk, size = [], 0
+            if not item:
+                continue
+        if chunk:
+            size += sep_length
+        chunk.append(item)
+        size += length
+    if chunk:
+        yield sep.join(chunk)
+
+def _resolve_tie(user_ids, pick, max_rounds):
+    """只在并列的玩家之间加赛，直到 pick(最高/最低) 唯一
+
+    返回 (胜出者, 每轮加赛的 {user_id: 点数})；超过 max_rounds 仍未分出结果时胜出者为 None。
+    """
+    rounds = []
+    tied = user_ids
+    while len(rounds) < max_rounds:
+        scores = {user_id: random.randint(1, 100) for user_id in tied}
+        rounds.append(scores)
+        target = pick(scores.values())
+        tied = [user_id for user_id, score in scores.items() if score == target]
+        if len(tied) == 1:
+            return tied[0], rounds
+    return None, rounds
+
+def _roll_dice_locked(chat_id, thread_id, user, current_time):
+    """完成一次掷骰的状态变更，返回待依次发送的 ([文本, ...], parse_mode)，调用方需持有该游戏的锁"""
+    game = _get_game(chat_id, thread_id)
+    if game is None:
+        return ['当前没有进行中的游戏。'], None
+
+    # 检查主持人权限
+    if user.id != game.host_id:
+        return [f'只有本次游戏的主持人（{game.host_name}）可以掷骰子。'], None
 
     # 更新主持人最后活跃时间和重置计时状态
-    async with games_lock:
-        if chat_id in games and thread_id in games[chat_id]:
-            game = games[chat_id][thread_id]
-            if user.id == game['host'].id:
-                game['host_last_active'] = current_time
-                game['timer_state'] = 0  # 重置计时状态
-
-    # 平局最多重试5次
-    async with last_roll_lock:
-        if chat_id in last_roll_time and thread_id in last_roll_time[chat_id]:
-            last_roll = last_roll_time[chat_id][thread_id]
-            if current_time - last_roll < 10:
-                async with games_lock:
-                    game = games.get(chat_id, {}).get(thread_id)
-                    if not game:
-                        return
-                remaining = 10 - int(current_time - last_roll) # 最小间隔10秒
-                remaining = max(0, remaining)
-                if user.id != game['host'].id:
-                    host_name = game['host'].full_name
-                    await update.message.reply_text(f'只有本次游戏的主持人（{host_name}）可以掷骰子。')
-                    return
-                else:
-                    await update.message.reply_text(f"⏳ 你扔的太快了吧，请等待 {remaining} 秒")
-                    return 
+    _touch_host(chat_id, thread_id, game, current_time)
 
-    async with games_lock:
-        if chat_id not in games or thread_id not in games[chat_id]:
-            await update.message.reply_text('当前没有进行中的游戏。')
-            return
-        
-        game = games[chat_id][thread_id]
+    # 最小间隔：每个游戏一个容量为 1 的令牌桶，掷骰成功才消耗
+    if ROLL_COOLDOWN > 0:
+        wait = roll_cooldowns.wait_time((chat_id, thread_id), current_time)
+        if wait > 0:
+            return [f"⏳ 你扔的太快了吧，请等待 {math.ceil(wait)} 秒"], None
 
-        # 检查主持人权限
-        if user.id != game['host'].id:
-            host_name = game['host'].full_name
-            await update.message.reply_text(f'只有本次游戏的主持人（{host_name}）可以掷骰子。')
-            return
+    # 检查参与者数量
+    participants = game.participants
+    if len(participants) < 2:
+        return ['至少需要两名参与者才能掷骰子。'], None
 
-        # 检查参与者数量
-        if len(game['participants']) < 2:
-            await update.message.reply_text('至少需要两名参与者才能掷骰子。')
-            return
-        
-        while retry_count < max_retries:
+    compact = ROLL_COMPACT_THRESHOLD and len(participants) > ROLL_COMPACT_THRESHOLD
 
-            #  掷骰子 
-            rolls = {
-                user_id: random.randint(1, 100)
-                for user_id in games[chat_id][thread_id]['participants']
-            }
+    def format_tie_rounds(title, rounds, highest):
+        yield "", 0
+        yield _measured(title)
+        for i, scores in enumerate(rounds, 1):
+            ranked = scores.items()
+            omitted = 0
+            if compact and len(scores) > ROLL_COMPACT_K:
+                # 精简模式只列出最接近胜出（或落败）的 K 人
+                ranked = sorted(ranked, key=lambda item: item[1], reverse=highest)
+                omitted = len(ranked) - ROLL_COMPACT_K
+                ranked = ranked[:ROLL_COMPACT_K]
+            entries = [_measured(f"{html.escape(participants[user_id].full_name)} {score}") for user_id, score in ranked]
+            if omitted:
+                entries.append(_measured(f"另有 {omitted} 人"))
+            # 并列的人很多时一轮也可能超长，按同样的规则折成多行
+            for line in _pack(entries, MAX_MESSAGE_LENGTH // 2, sep="，"):
+                yield _measured(f"第{i}轮：{line}")
+
+    def format_roll(user_id, score):
+        participant = participants[user_id]
+        return f"{participant.display}: {score}", participant.display_length + 2 + len(str(score))
 
-            def get_user_display(user_id):
-                user_info = game['participant_info'][user_id]
-                if user_info['username']:
-                    return f'<a href="{user_info["join_message_link"]}">🔗 </a>{user_info["full_name"]}'
+    def format_rolls(rolls):
+        yield _measured(f"🎲 本局玩家共（{len(rolls)}人） 🎲")
+        yield "", 0
+        if compact:
+            ranked = sorted(rolls.items(), key=lambda item: item[1], reverse=True)
+            hidden = len(ranked) - 2 * ROLL_COMPACT_K
+            if hidden > 0:
+                ranked = ranked[:ROLL_COMPACT_K] + [None] + ranked[-ROLL_COMPACT_K:]
+            for entry in ranked:
+                if entry is None:
+                    yield _measured(f"…… 省略中间 {hidden} 名玩家 ……")
                 else:
-                    return f'<a href="{user_info["join_message_link"]}">🔗 </a>{user_info["full_name"]}'
+                    yield format_roll(*entry)
+        else:
+            for entry in rolls.items():
+                yield format_roll(*entry)
 
+    #  掷骰子
+    rolls = {
+        user_id: random.randint(1, 100)
+        for user_id in participants
+    }
 
-            participant_count = len(rolls)
+    sections = [format_rolls(rolls)]
 
-            results = (
-                f"🎲 本局玩家共（{participant_count}人） 🎲\n\n"
-                + "\n".join([
-                    f"{get_user_display(user_id)}: {score}"
-                    for user_id, score in rolls.items()
-                ])
-            )
+    # 计算胜负
+    max_score = max(rolls.values())
+    min_score = min(rolls.values())
+    max_users = [user_id for user_id, score in rolls.items() if score == max_score]
+    min_users = [user_id for user_id, score in rolls.items() if score == min_score]
 
-            # 计算胜负
-            max_score = max(rolls.values())
-            min_score = min(rolls.values())
-            max_users = [user_id for user_id, score in rolls.items() if score == max_score]
-            min_users = [user_id for user_id, score in rolls.items() if score == min_score]
-
-            # 处理平局（自动重掷）
-            if len(max_users) == 1 and len(min_users) == 1:
-                winner_info = game['participant_info'][max_users[0]]
-                loser_info = game['participant_info'][min_users[0]]
-                winner_name = f"@{winner_info['username']}" if winner_info['username'] else winner_info['full_name']
-                loser_name = f"@{loser_info['username']}" if loser_info['username'] else loser_info['full_name']
-                await update.message.reply_text(
-                    f"{results}\n\n🏆 胜利者: {winner_name}\n😵 失败者: {loser_name}",
-                    parse_mode='HTML'
-                )
-                break
-            else:
-                retry_count += 1
-                await update.message.reply_text(
-                    f"{results}\n\n⚠️ 出现平局！重新掷骰子...", 
-                    parse_mode='HTML'
-                )
-                await asyncio.sleep(1)
-        else:
-            # 多次平局后结束自动重roll
-            await update.message.reply_text("多次平局，游戏终止，请手动处理。")
-            return
-        
-    async with last_roll_lock:
-            if chat_id not in last_roll_time:
-                last_roll_time[chat_id] = {}
-            last_roll_time[chat_id][thread_id] = time.time()  
+    # 处理平局：只让并列最高分（或最低分）的玩家加赛
+    tie_notes = []  # 大厅消息中显示的加赛情况
+    winner = max_users[0]
+    if len(max_users) > 1:
+        winner, rounds = _resolve_tie(max_users, max, MAX_TIE_REROLLS)
+        sections.append(format_tie_rounds("⚠️ 最高分平局，并列玩家加赛：", rounds, True))
+        tie_notes.append(f"最高分 {len(max_users)} 人平局，加赛 {len(rounds)} 轮")
+
+    loser = None
+    if winner is not None:
+        # 所有人同分时，最低分候选需要排除已经胜出的玩家
+        min_candidates = [user_id for user_id in min_users if user_id != winner]
+        loser = min_candidates[0]
+        if len(min_candidates) > 1:
+            loser, rounds = _resolve_tie(min_candidates, min, MAX_TIE_REROLLS)
+            sections.append(format_tie_rounds("⚠️ 最低分平局，并列玩家加赛：", rounds, False))
+            tie_notes.append(f"最低分 {len(min_candidates)} 人平局，加赛 {len(rounds)} 轮")
+
+    if winner is None or loser is None:
+        # 多次平局后结束自动重roll
+        conclusion = "多次平局，游戏终止，请手动处理。"
+        tie_notes.append("仍未分出胜负")
+    else:
+        # 胜负作为一整块参与分段，保证两者一起出现在最后一条消息中
+        conclusion = f"🏆 胜利者: {participants[winner].mention}\n😵 失败者: {participants[loser].mention}"
+        stats_store.record_roll(chat_id, game, rolls, winner, loser)
+        game.last_roll_time = time.time()
+        if ROLL_COOLDOWN > 0:
+            roll_cooldowns.consume((chat_id, thread_id), 1 / ROLL_COOLDOWN, 1, game.last_roll_time)
+        game_store.save_game(chat_id, thread_id, game)
+        # 每人的点数以 (user_id, 点数) 对的形式记下（JSON 的对象键只能是字符串），序列化在写入线程中进行
+        game_store.record_event('roll', chat_id, thread_id, game.last_roll_time, winner, loser, tuple(rolls.items()))
+
+    if LOBBY_MODE and tie_notes:
+        _lobby_changed(chat_id, thread_id, "⚠️ 上一局" + "，".join(tie_notes))
+    sections.append((("", 0), _measured(conclusion)))
+    return list(_pack(itertools.chain.from_iterable(sections), MAX_MESSAGE_LENGTH)), 'HTML'
     
 
+class AdminCache:
+    """群管理员缓存
+
+    每个群组用一次 getChatAdministrators 整体拉取管理员列表，按 TTL 过期、超出容量时淘汰最久未用的群组；
+    同一群组的并发查询共享同一个进行中的请求。
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # chat_id -> (过期时间, 管理员 user_id 集合)
+        self._inflight = {}  # chat_id -> 进行中的拉取任务
+
+    async def is_admin(self, bot, chat_id, user_id) -> bool:
+        return user_id in await self.get_admins(bot, chat_id)
+
+    async def get_admins(self, bot, chat_id) -> frozenset:
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = self._inflight[chat_id] = asyncio.ensure_future(self._fetch(bot, chat_id))
+        # shield：某个等待者被取消时不影响共享的请求
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, chat_id) -> frozenset:
+        me = asyncio.current_task()
+        try:
+            members = await bot.get_chat_administrators(chat_id)
+            admins = frozenset(
+                member.user.id for member in members
+                if isinstance(member, (ChatMemberAdministrator, ChatMemberOwner))
+            )
+            # 请求期间缓存被 invalidate 过，结果可能已过时，不写入缓存
+            if self._inflight.get(chat_id) is me:
+                self._entries[chat_id] = (time.monotonic() + self.ttl, admins)
+                self._entries.move_to_end(chat_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return admins
+        finally:
+            if self._inflight.get(chat_id) is me:
+                del self._inflight[chat_id]
+
+    def invalidate(self, chat_id) -> None:
+        self._entries.pop(chat_id, None)
+        self._inflight.pop(chat_id, None)
+
+    def purge_expired(self, now) -> None:
+        """删除已过期的条目，不再查询的群组不必等到被容量淘汰"""
+        for chat_id in [chat_id for chat_id, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[chat_id]
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+
+async def chat_member_updated(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """群成员（包括 bot 自身）权限变动时让该群的管理员缓存失效"""
+    admin_cache.invalidate(update.effective_chat.id)
+
 async def admin_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     thread_id = getattr(update.message, "message_thread_id", 0)
     user = update.effective_user
 
-    # 获取用户的权限
-    member = await context.bot.get_chat_member(chat_id, user.id)
-    if not isinstance(member, (ChatMemberAdministrator, ChatMemberOwner)):
-        await update.message.reply_text("只有管理员可以使用 /adminstop 结束游戏。")
+    # 获取用户的权限（优先使用缓存，不持有任何锁），私聊中没有管理员
+    is_admin = (
+        update.effective_chat.type != 'private'
+        and await admin_cache.is_admin(context.bot, chat_id, user.id)
+    )
+    if not is_admin:
+        send_reply(update, "只有管理员可以使用 /adminstop 结束游戏。")
         return
 
-    async with games_lock:
-        if chat_id in games and thread_id in games[chat_id]:
-            del games[chat_id][thread_id]
-            await update.message.reply_text("管理员已结束游戏。")
+    async with game_lock(chat_id, thread_id):
+        if _get_game(chat_id, thread_id) is not None:
+            _drop_game(chat_id, thread_id, 'adminstop')
+            reply = "管理员已结束游戏。"
         else:
-            await update.message.reply_text("当前没有进行中的游戏。")
-            return
-        
-    async with last_roll_lock:
-        if chat_id in last_roll_time and thread_id in last_roll_time[chat_id]:
-            del last_roll_time[chat_id][thread_id]
+            reply = "当前没有进行中的游戏。"
+
+    send_reply(update, reply)
 
-async def game_timer_check(context: CallbackContext) -> None:
-    """每分钟检查所有游戏的计时器状态"""
+async def game_timer_check(context: CallbackContext = None) -> None:
+    """处理所有已到截止时间的游戏，开销只与到期的游戏数量有关"""
+    global _stale_timers
     current_time = time.time()
-    tasks = []
     
-    # 快速收集需要处理的任务而不持有锁
-    async with games_lock:
-        active_games = []
-        for chat_id, threads in games.items():
-            for thread_id, game in threads.items():
-                active_games.append((
-                    chat_id,
-                    thread_id,
-                    game['game_start_time'],
-                    game['host_last_active'],
-                    game.get('timer_state', 0)
-                ))
+    while timer_heap and timer_heap[0][0] <= current_time:
+        _, seq, chat_id, thread_id = heapq.heappop(timer_heap)
+        game = games.get((chat_id, thread_id))
+        if game is None and spill_store is not None and spill_store.tokens.get((chat_id, thread_id)) == seq:
+            # 换出的游戏到了提醒时间，读回内存照常处理
+            game = _get_game(chat_id, thread_id)
+        if game is None or game.timer_token != seq:
+            # 游戏已结束或主持人有新操作，条目已失效
+            _stale_timers = max(0, _stale_timers - 1)
+            continue
     
-    # 并行处理每个游戏的状态
-    for chat_id, thread_id, start_time, last_active, timer_state in active_games:
-        elapsed_time = current_time - start_time
-        inactive_time = current_time - last_active
-        timer_key = (chat_id, thread_id)
-        
-        # 10分钟提醒
-        if WARNING_10_MIN <= elapsed_time < WARNING_20_MIN and inactive_time >= WARNING_10_MIN:
-            if timer_state < 10:
-                await timer_queue.put((
-                    chat_id, thread_id, 
-                    "⏰ 本轮游戏已经过去10分钟咯",
-                    10
-                ))
+        # 下一阶段在 timer_task_processor 更新状态后再安排
+        game.timer_token = None
+        _, next_state, text = TIMER_STAGES[game.timer_state]
+        timer_queue.put_nowait((chat_id, thread_id, text, next_state))
         
-        # 20分钟提醒
-        elif WARNING_20_MIN <= elapsed_time < GAME_TIMEOUT and inactive_time >= WARNING_20_MIN:
-            if timer_state < 20:
-                await timer_queue.put((
-                    chat_id, thread_id,
-                    "⏰ 本轮游戏已经过去20分钟咯，如果超过30分钟主持人无操作，本次游戏将自动结束",
-                    20
-                ))
+async def game_timer_scheduler(context: CallbackContext) -> None:
+    """休眠到最早的截止时间（或被新的更早截止时间唤醒）后处理到期游戏"""
+    while True:
+        try:
+            await game_timer_check(context)
+        except Exception as e:
+            logging.error(f"定时检查错误: {e}")
         
-        # 30分钟超时自动结束
-        elif inactive_time >= GAME_TIMEOUT:
-            await timer_queue.put((
-                chat_id, thread_id,
-                "⏰ 超过30分钟无操作，游戏已自动结束",
-                30
-            ))
+        timeout = TIMER_INTERVAL
+        if timer_heap:
+            timeout = min(timeout, max(0.0, timer_heap[0][0] - time.time()))
+        timer_wakeup.clear()
+        # 不用 wait_for：唤醒和取消同时发生时 wait_for 可能吞掉取消，导致退出时卡住
+        waiter = asyncio.ensure_future(timer_wakeup.wait())
+        try:
+            await asyncio.wait((waiter,), timeout=timeout)
+        finally:
+            waiter.cancel()
 
 async def timer_task_processor():
-    """处理定时器任务队列"""
+    """处理定时器任务队列，每个任务处理完后 task_done()，退出时据此等待队列处理完"""
     while True:
+        # 获取任务并处理
+        chat_id, thread_id, text, timer_state = await timer_queue.get()
         try:
-            # 获取任务并处理
-            chat_id, thread_id, text, timer_state = await timer_queue.get()
-            
-            # 更新游戏状态
-            async with games_lock:
-                if chat_id in games and thread_id in games[chat_id]:
-                    game = games[chat_id][thread_id]
-                    
-                    if timer_state == 30:  # 结束游戏
-                        del games[chat_id][thread_id]
-                        if not games[chat_id]:
-                            del games[chat_id]
-                        
-                        async with last_roll_lock:
-                            if chat_id in last_roll_time and thread_id in last_roll_time[chat_id]:
-                                del last_roll_time[chat_id][thread_id]
-                                if not last_roll_time[chat_id]:
-                                    del last_roll_time[chat_id]
-                    else:  # 更新计时状态
-                        game['timer_state'] = timer_state
+            # 更新游戏状态，只锁住对应的游戏
+            async with game_lock(chat_id, thread_id):
+                game = games.get((chat_id, thread_id))
+                # 入队后主持人又有操作（已重新安排计时）或游戏已结束，提醒作废
+                if game is None or game.timer_token is not None:
+                    continue
+
+                # 大厅消息模式下提醒写进大厅消息；没有大厅消息（如重启恢复）的游戏超时结束时仍单独发送
+                in_lobby = LOBBY_MODE and (timer_state != 30 or (chat_id, thread_id) in lobbies)
+                if timer_state == 30:  # 结束游戏
+                    _drop_game(chat_id, thread_id, 'timeout')
+                else:  # 更新计时状态并安排下一阶段
+                    game.timer_state = timer_state
+                    _schedule_game_timer(chat_id, thread_id, game)
+                    game_store.save_game(chat_id, thread_id, game)
+                    game_store.record_event('timer', chat_id, thread_id, time.time(), timer_state)
+                    if LOBBY_MODE:
+                        _lobby_changed(chat_id, thread_id, text)
             
+            if metrics is not None:
+                metrics.inc('tod_timer_actions_total', (('stage', str(timer_state)),))
+
             # 将消息加入发送队列
-            await message_queue.put((chat_id, thread_id, text))
+            if not in_lobby:
+                enqueue_message(chat_id, thread_id, text, priority=PRIORITY_REMINDER)
             
         except Exception as e:
             logging.error(f"定时任务处理错误: {e}")
             await asyncio.sleep(1)
+        finally:
+            timer_queue.task_done()
+
+class TokenBucket:
+    """令牌桶：按 rate(个/秒) 匀速补充，最多积攒 capacity 个"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait_time(self, now) -> float:
+        """还需等待多少秒才能拿到一个令牌"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SharedTokenBucket:
+    """放在共享内存中的令牌桶，多个工作进程共用同一份全局发送额度，接口与 TokenBucket 相同
+
+    不同进程可能同时通过 wait_time 检查，因此 consume 总是扣除令牌（允许欠账），
+    欠下的令牌会让之后的 wait_time 变长，合计速率仍不超过 rate。
+    """
+
+    def __init__(self, mp_context, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        # [剩余令牌, 上次补充时间]，time.monotonic() 在同一台机器的进程间可比较
+        self._state = mp_context.Array('d', [capacity, time.monotonic()])
+
+    def _refill(self, state, now) -> None:
+        if now > state[1]:
+            state[0] = min(self.capacity, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+
+    def wait_time(self, now) -> float:
+        with self._state.get_lock():
+            self._refill(self._state, now)
+            tokens = self._state[0]
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate
+
+    def consume(self, now) -> bool:
+        with self._state.get_lock():
+            self._refill(self._state, now)
+            had_token = self._state[0] >= 1
+            self._state[0] -= 1
+        return had_token
+
+    def is_full(self, now) -> bool:
+        with self._state.get_lock():
+            self._refill(self._state, now)
+            return self._state[0] >= self.capacity
+
+
+class RateLimiter:
+    """按键划分的一组令牌桶
+
+    桶在第一次消耗时创建，还没有桶的键视为额度已满；补满的桶和新建的桶等价，
+    由 sweep() 定期清除，总数超过 max_size 时先清理、仍不够再淘汰最早创建的桶，内存有上限。
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buckets = {}  # key -> TokenBucket
+
+    def wait_time(self, key, now) -> float:
+        bucket = self.buckets.get(key)
+        return 0.0 if bucket is None else bucket.wait_time(now)
+
+    def consume(self, key, rate, capacity, now) -> None:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_size:
+                self.sweep(now)
+                while len(self.buckets) >= self.max_size:
+                    del self.buckets[next(iter(self.buckets))]
+            bucket = self.buckets[key] = TokenBucket(rate, capacity, now)
+        bucket.consume(now)
+
+    def acquire(self, key, rate, capacity, now) -> float:
+        """有令牌时取走一个并返回 0，否则返回还需等待的秒数"""
+        wait = self.wait_time(key, now)
+        if wait <= 0:
+            self.consume(key, rate, capacity, now)
+        return wait
+
+    def discard(self, key) -> None:
+        self.buckets.pop(key, None)
+
+    def sweep(self, now) -> int:
+        idle = [key for key, bucket in self.buckets.items() if bucket.is_full(now)]
+        for key in idle:
+            del self.buckets[key]
+        return len(idle)
+
+# 命令限流：键为 (命令, 'u', user_id) 和 (命令, 'c', chat_id)，使用 time.monotonic()
+command_limiter = RateLimiter(RATE_LIMIT_MAX_BUCKETS)
+# 限流提示：键为 (user_id, chat_id)，每 FLOOD_NOTICE_INTERVAL 秒最多提示一次
+flood_notices = RateLimiter(RATE_LIMIT_MAX_BUCKETS)
+# 掷骰冷却：键为 (chat_id, thread_id)，使用 time.time()，以便从存储中的 last_roll_time 恢复
+roll_cooldowns = RateLimiter(RATE_LIMIT_MAX_BUCKETS)
+
+def _command_name(message, bot_username):
+    """消息开头的命令名（不含 / 和 @bot），发给其他 bot 的命令返回 None"""
+    text = message.text
+    if not text or text[0] != '/':
+        return None
+    parts = text[1:].split(maxsplit=1)
+    if not parts:
+        return None
+    command, _, target = parts[0].partition('@')
+    if target and target.lower() != (bot_username or '').lower():
+        return None
+    return command.lower()
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """在所有命令之前执行（group -1）：超过频率限制的命令直接丢弃，后续的处理函数不会执行
+
+    同一用户在同一群组被限流时只提示一次，之后 FLOOD_NOTICE_INTERVAL 秒内的超限命令不再回复，
+    避免刷屏的人反过来让 bot 刷屏；整个群组超限时按群组只提示一次，不论有多少账号在发命令。
+    """
+    message = update.effective_message
+    if message is None or update.effective_user is None:
+        return
+    command = _command_name(message, context.bot.username)
+    limits = COMMAND_RATE_LIMITS.get(command)
+    if limits is None:
+        return
+
+    user_count, user_period, chat_count, chat_period = limits
+    user_key = (command, 'u', update.effective_user.id)
+    chat_key = (command, 'c', update.effective_chat.id)
+    now = time.monotonic()
+    user_wait = command_limiter.wait_time(user_key, now)
+    chat_wait = command_limiter.wait_time(chat_key, now)
+    wait = max(user_wait, chat_wait)
+    if wait <= 0:
+        command_limiter.consume(user_key, user_count / user_period, user_count, now)
+        command_limiter.consume(chat_key, chat_count / chat_period, chat_count, now)
+        return
+
+    if metrics is not None:
+        metrics.inc('tod_commands_throttled_total', (('command', command),))
+    if chat_wait > 0:
+        notice_key = ('c', update.effective_chat.id)
+    else:
+        notice_key = ('u', update.effective_user.id, update.effective_chat.id)
+    if flood_notices.acquire(notice_key, 1 / FLOOD_NOTICE_INTERVAL, 1, now) <= 0:
+        send_reply(update, f"⏳ 操作太频繁，请 {math.ceil(wait)} 秒后再试。")
+    raise ApplicationHandlerStop
+
+async def rate_limit_sweeper(context: CallbackContext) -> None:
+    """定期清除已补满的令牌桶"""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        command_limiter.sweep(time.monotonic())
+        flood_notices.sweep(time.monotonic())
+        roll_cooldowns.sweep(time.time())
+
+def spill_idle_games(now) -> int:
+    """换出主持人闲置超过 GAME_SPILL_IDLE 的游戏，仍超出 MAX_RESIDENT_GAMES 时再换出最久无操作的游戏
+
+    计时提醒已入队（timer_token 为 None）或锁正被持有的游戏不换出。返回换出的游戏数。
+    """
+    candidates = []
+    for key, game in games.items():
+        if game.timer_token is None:
+            continue
+        lock = game_locks.get(key)
+        if lock is not None and lock.locked():
+            continue
+        candidates.append((game.host_last_active, key))
+
+    victims = [c for c in candidates if now - c[0] >= GAME_SPILL_IDLE] if GAME_SPILL_IDLE else []
+    excess = len(games) - len(victims) - MAX_RESIDENT_GAMES if MAX_RESIDENT_GAMES else 0
+    if excess > 0:
+        chosen = {key for _, key in victims}
+        victims += heapq.nsmallest(excess, (c for c in candidates if c[1] not in chosen))
+
+    for _, key in victims:
+        # 等待这个锁的协程发现锁已被清理后会重新获取新锁，并通过 _get_game 读回游戏
+        game_locks.pop(key, None)
+        spill_store.spill(key[0], key[1], games.pop(key))
+    return len(victims)
+
+async def memory_janitor(context: CallbackContext) -> None:
+    """定期换出闲置游戏，清理空闲群组的发送状态和过期的管理员缓存"""
+    while True:
+        await asyncio.sleep(MEMORY_JANITOR_INTERVAL)
+        if spill_store is not None:
+            spilled = spill_idle_games(time.time())
+            if spilled:
+                logging.info(f"已换出 {spilled} 个闲置游戏，当前换出 {len(spill_store.tokens)} 个")
+            try:
+                await spill_store.flush()
+            except Exception as e:
+                logging.error(f"换出游戏写入失败: {e}")
+        _sweep_chat_send_states(time.monotonic())
+        admin_cache.purge_expired(time.monotonic())
+
+
+class OutboundMessage:
+    """一条待发送的消息；edit_message_id 不为空时改为编辑这条已发出的消息"""
+    __slots__ = (
+        'chat_id', 'thread_id', 'text', 'parse_mode', 'reply_to', 'edit_message_id', 'on_sent', 'attempts', 'enqueued_at'
+    )
+
+    def __init__(self, chat_id, thread_id, text, parse_mode=None, reply_to=None, edit_message_id=None, on_sent=None):
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_to = reply_to
+        self.edit_message_id = edit_message_id
+        self.on_sent = on_sent  # 发送完成（或最终失败）后以 Bot API 的返回值（失败时为 None）调用
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class ChatSendState:
+    """单个聊天的发送状态：限速令牌桶、被限流到何时、是否有消息正在发送"""
+    __slots__ = ('bucket', 'blocked_until', 'sending', 'waiting')
+
+    def __init__(self, chat_id, now):
+        # 群组按每分钟条数限速，私聊每秒一条
+        if chat_id < 0:
+            self.bucket = TokenBucket(MAX_MESSAGES_PER_CHAT_PER_MINUTE / 60, CHAT_BURST, now)
+        else:
+            self.bucket = TokenBucket(1, 1, now)
+        self.blocked_until = 0.0
+        self.sending = False
+        self.waiting = []
+
+    def is_idle(self, now) -> bool:
+        return not self.sending and not self.waiting and self.blocked_until <= now and self.bucket.is_full(now)
+
+
+def enqueue_message(chat_id, thread_id, text, priority=PRIORITY_REPLY, parse_mode=None, reply_to=None,
+                    edit_message_id=None, on_sent=None) -> None:
+    """把消息交给限速发送器，不等待发送完成"""
+    global pending_sends
+    pending_sends += 1
+    message = OutboundMessage(chat_id, thread_id, text, parse_mode, reply_to, edit_message_id, on_sent)
+    message_queue.put_nowait((priority, next(_message_seq), message))
+
+def send_reply(update: Update, text, parse_mode=None) -> None:
+    """回复触发命令的消息（经由发送队列，优先于定时提醒）"""
+    enqueue_message(
+        update.effective_chat.id,
+        getattr(update.message, "message_thread_id", 0),
+        text,
+        priority=PRIORITY_REPLY,
+        parse_mode=parse_mode,
+        reply_to=update.message.message_id
+    )
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+def _sweep_chat_send_states(now) -> None:
+    for chat_id in [chat_id for chat_id, state in chat_send_states.items() if state.is_idle(now)]:
+        del chat_send_states[chat_id]
+
+async def _deliver(bot, item, state: ChatSendState, send_slots: Semaphore) -> None:
+    """发送一条消息；被限流或网络错误时只推迟这个聊天，然后把它重新放回队列"""
+    global pending_sends
+    priority, seq, message = item
+    requeue = False
+    failure = None
+    result = None
+    try:
+        if message.edit_message_id is not None:
+            result = await bot.edit_message_text(
+                text=message.text,
+                chat_id=message.chat_id,
+                message_id=message.edit_message_id,
+                parse_mode=message.parse_mode
+            )
+        else:
+            result = await bot.send_message(
+                chat_id=message.chat_id,
+                message_thread_id=message.thread_id if message.thread_id != 0 else None,
+                text=message.text,
+                parse_mode=message.parse_mode,
+                reply_parameters=(
+                    ReplyParameters(message_id=message.reply_to, allow_sending_without_reply=True)
+                    if message.reply_to else None
+                )
+            )
+    except RetryAfter as e:
+        # 只暂停被限流的聊天，其他聊天照常发送
+        state.blocked_until = time.monotonic() + _retry_after_seconds(e)
+        requeue = True
+        failure = 'retry_after'
+    except BadRequest as e:
+        if message.edit_message_id is not None and "not modified" in str(e):
+            # 内容和上次编辑相同，视为成功
+            result = True
+        elif message.edit_message_id is not None:
+            # 被编辑的消息已被删除等：改为发送一条新消息
+            logging.warning(f"编辑消息失败，改为发送新消息: {e}")
+            message.edit_message_id = None
+            requeue = True
+            failure = 'bad_request'
+        else:
+            logging.error(f"消息发送失败: {e}")
+            failure = 'bad_request'
+    except (TimedOut, NetworkError) as e:
+        message.attempts += 1
+        if message.attempts < MAX_SEND_ATTEMPTS:
+            state.blocked_until = time.monotonic() + 2 ** message.attempts
+            requeue = True
+        else:
+            logging.error(f"消息发送失败（已重试{message.attempts}次）: {e}")
+        failure = 'network'
+    except Exception as e:
+        logging.error(f"消息发送失败: {e}")
+        failure = 'other'
+    finally:
+        if metrics is not None:
+            if failure is None:
+                metrics.inc('tod_messages_sent_total')
+            else:
+                metrics.inc('tod_message_send_failures_total', (('reason', failure),))
+        state.sending = False
+        send_slots.release()
+        if requeue:
+            message_queue.put_nowait(item)
+        else:
+            pending_sends -= 1
+            if message.on_sent is not None:
+                try:
+                    message.on_sent(result)
+                except Exception as e:
+                    logging.error(f"发送完成回调出错: {e}")
+        for waiting_item in state.waiting:
+            message_queue.put_nowait(waiting_item)
+        state.waiting.clear()
+
+def _delivery_done(task) -> None:
+    delivery_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("发送任务异常退出", exc_info=task.exception())
 
 async def message_queue_sender(context: CallbackContext):
-    """以可控速率发送队列中的消息"""
+    """按优先级发送队列中的消息，同时遵守全局和单个聊天的发送速率
+
+    - 队列为空时阻塞在 get() 上，不轮询
+    - 单个聊天超速或被 RetryAfter 限流时，只把该聊天的消息延后重新入队
+    - 同一聊天同一时刻最多一条消息在发送，保证顺序
+    """
+    loop = asyncio.get_running_loop()
+    global_bucket = send_budget or TokenBucket(MAX_MESSAGES_PER_SECOND, GLOBAL_BURST, time.monotonic())
+    send_slots = Semaphore(MAX_CONCURRENT_SENDS)
+    last_sweep = time.monotonic()
+
+    global sender_heartbeat, sender_lag
     while True:
-        messages_to_send = []
-        start_time = time.time()
+        item = await message_queue.get()
+        priority, seq, message = item
+        now = sender_heartbeat = time.monotonic()
         
-        # 批量获取消息（最多MAX_MESSAGES_PER_SECOND条）
-        for _ in range(MAX_MESSAGES_PER_SECOND):
-            if not message_queue.empty():
-                messages_to_send.append(await message_queue.get())
+        state = chat_send_states.get(message.chat_id)
+        if state is None:
+            state = chat_send_states[message.chat_id] = ChatSendState(message.chat_id, now)
         
-        # 发送消息
-        for chat_id, thread_id, text in messages_to_send:
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    message_thread_id=thread_id if thread_id != 0 else None,
-                    text=text
-                )
-            except Exception as e:
-                logging.error(f"消息发送失败: {e}")
+        if state.sending:
+            state.waiting.append(item)
+            continue
         
-        # 控制速率
-        elapsed = time.time() - start_time
-        if elapsed < 1.0 and messages_to_send:
-            await asyncio.sleep(1.0 - elapsed)
-        elif not messages_to_send:
-            await asyncio.sleep(0.5)
+        delay = max(state.blocked_until - now, state.bucket.wait_time(now))
+        if delay > 0:
+            if metrics is not None:
+                metrics.observe('tod_send_rate_limit_delay_seconds', delay, (('scope', 'chat'),))
+            # 之后到达的同一聊天消息也会排在这个时间点之后，保证顺序
+            state.blocked_until = now + delay
+            loop.call_later(delay, message_queue.put_nowait, item)
+            continue
 
-def main():
-    application = Application.builder().token(TOKEN).build()
-
-    # 添加命令
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("createnewgame", create_game))
-    application.add_handler(CommandHandler("stop", stop_game))
-    application.add_handler(CommandHandler("join", join_game))
-    application.add_handler(CommandHandler("leave", leave_game))
-    application.add_handler(CommandHandler("roll", roll_dice))
-    application.add_handler(CommandHandler("adminstop", admin_stop))
-    
-    # 定时任务
-    application.job_queue.run_repeating(
-        game_timer_check, 
-        interval=TIMER_INTERVAL, 
-        first=0
-    )
-    
-    # 队列处理器
-    application.job_queue.run_once(
-        lambda ctx: asyncio.create_task(timer_task_processor()), 
-        when=0
+        wait = global_bucket.wait_time(now)
+        if wait > 0:
+            if metrics is not None:
+                metrics.observe('tod_send_rate_limit_delay_seconds', wait, (('scope', 'global'),))
+            await asyncio.sleep(wait)
+            now = time.monotonic()
+        global_bucket.consume(now)
+        state.bucket.consume(now)
+
+        await send_slots.acquire()
+        state.sending = True
+        sender_lag = time.monotonic() - message.enqueued_at
+        task = asyncio.create_task(_deliver(context.bot, item, state, send_slots))
+        delivery_tasks.add(task)
+        task.add_done_callback(_delivery_done)
+
+        if now - last_sweep > 60:
+            _sweep_chat_send_states(now)
+            last_sweep = now
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新，但同一 (chat_id, thread_id) 的更新严格按到达顺序依次处理
+
+    每个键只记录最后一个更新的完成信号，新更新先等前一个完成、再占用并发名额，
+    这样同一群组刷屏时不会占满名额而拖慢其他群组。
+    排队和并发名额都在 do_process_update 中实现，只依赖 BaseUpdateProcessor 的公开接口：
+    基类的 process_update 会先获取它自己的信号量再调用 do_process_update，
+    所以交给基类的上限不设实际限制，真正的上限由 _slots 控制。
+    """
+    __slots__ = ('_tails', '_slots')
+
+    def __init__(self, max_concurrent_updates: int):
+        # 基类的信号量在排队之前获取，若用真实上限，等待中的更新就会占住名额
+        super().__init__(sys.maxsize)
+        if max_concurrent_updates < 1:
+            raise ValueError("错误: MAX_CONCURRENT_UPDATES 必须大于 0")
+        self._slots = Semaphore(max_concurrent_updates)
+        self._tails = {}
+
+    @staticmethod
+    def _order_key(update):
+        if not isinstance(update, Update) or update.effective_chat is None:
+            return None
+        return update.effective_chat.id, getattr(update.effective_message, "message_thread_id", None)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._order_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._slots:
+                await coroutine
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# 常驻的后台循环任务：名称 -> 任务，由 Application 的生命周期钩子启动和停止
+background_tasks = {}
+background_failures = {}  # 名称 -> (重启次数, 最近一次失败的时间, 错误)
+_health_problems = []
+
+def health_status() -> dict:
+    """后台任务是否在运行、发送器是否卡住或跟不上"""
+    now = time.monotonic()
+    problems = [f"后台任务 {name} 未运行" for name, task in background_tasks.items() if task.done()]
+    for name, (restarts, failed_at, error) in background_failures.items():
+        if now - failed_at < HEALTH_CHECK_INTERVAL * 2:
+            problems.append(f"后台任务 {name} 最近异常重启（共 {restarts} 次）: {error}")
+    if message_queue.qsize() and now - sender_heartbeat > HEALTH_STALL_SECONDS:
+        problems.append(f"发送器已 {now - sender_heartbeat:.0f} 秒没有取出消息")
+    if pending_sends and sender_lag > HEALTH_MAX_SEND_LAG:
+        problems.append(f"发送跟不上：消息排队 {sender_lag:.0f} 秒才发出，待发 {pending_sends} 条")
+    return {
+        'ok': not problems,
+        'problems': problems,
+        'tasks': {name: not task.done() for name, task in background_tasks.items()},
+        'pending_messages': pending_sends,
+        'message_queue_depth': message_queue.qsize(),
+        'timer_queue_depth': timer_queue.qsize(),
+        'send_lag_seconds': round(sender_lag, 3),
+    }
+
+async def health_monitor(context: CallbackContext) -> None:
+    """定期检查健康状况，出现问题或恢复时写日志"""
+    global _health_problems
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        problems = health_status()['problems']
+        if problems and problems != _health_problems:
+            logging.warning("健康检查发现问题: " + "；".join(problems))
+        elif not problems and _health_problems:
+            logging.warning("健康检查已恢复正常")
+        _health_problems = problems
+
+async def _supervise(name, loop_factory, application) -> None:
+    """运行常驻循环；循环异常退出时记录并在退避后重启，被取消时直接结束"""
+    delay = BACKGROUND_RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        try:
+            await loop_factory(application)
+            error = "循环意外结束"
+        except Exception as e:
+            error = repr(e)
+            logging.exception(f"后台任务 {name} 异常退出，{delay} 秒后重启")
+        restarts = background_failures.get(name, (0,))[0] + 1
+        background_failures[name] = (restarts, time.monotonic(), error)
+        if metrics is not None:
+            metrics.inc('tod_background_restarts_total', (('task', name),))
+        # 正常运行了一段时间后再失败，退避时间从头开始
+        if time.monotonic() - started > BACKGROUND_RESTART_MAX_DELAY:
+            delay = BACKGROUND_RESTART_DELAY
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BACKGROUND_RESTART_MAX_DELAY)
+
+def _background_loops() -> dict:
+    loops = {
+        'timer_scheduler': game_timer_scheduler,
+        'timer_processor': lambda application: timer_task_processor(),
+        'message_sender': message_queue_sender,
+        'game_store_flusher': game_store_flusher,
+        'stats_flusher': stats_flusher,
+        'rate_limit_sweeper': rate_limit_sweeper,
+        'memory_janitor': memory_janitor,
+        'health_monitor': health_monitor,
+    }
+    if metrics is not None:
+        loops['metrics_server'] = metrics_server
+    return loops
+
+async def start_background_tasks(application: Application) -> None:
+    """post_init：启动受监管的后台循环（循环通过 application.bot 发送消息）"""
+    for name, loop_factory in _background_loops().items():
+        if name not in background_tasks:
+            background_tasks[name] = asyncio.create_task(_supervise(name, loop_factory, application))
+
+async def _cancel_background(names) -> None:
+    tasks = [background_tasks.pop(name) for name in names if name in background_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def stop_background_tasks(application: Application) -> None:
+    """post_stop：在 SHUTDOWN_DRAIN_TIMEOUT 内处理完已到期的定时任务、发完待发消息，再取消所有后台循环
+
+    先停掉计时调度器，不再产生新的提醒；已入队的提醒和超时结束照常处理。
+    发送器继续按全局和单个聊天的限速发送，停止后等待已发出的请求结束；超过期限仍未发出的消息放弃并记录数量。
+    """
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    await _cancel_background(['timer_scheduler'])
+    if 'timer_processor' in background_tasks:
+        try:
+            await asyncio.wait_for(timer_queue.join(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+    if 'message_sender' in background_tasks:
+        # 等待中的大厅消息编辑不再延迟，直接提交
+        while (
+            (flush_lobbies() or pending_sends)
+            and time.monotonic() < deadline
+            and not background_tasks['message_sender'].done()
+        ):
+            await asyncio.sleep(0.05)
+    await _cancel_background(['message_sender'])
+    if delivery_tasks:
+        # 发送器已停止，等待已发出的请求结束，超过期限的取消
+        _, unfinished = await asyncio.wait(set(delivery_tasks), timeout=max(0.0, deadline - time.monotonic()))
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+    if pending_sends or timer_queue.qsize():
+        logging.warning(f"退出时仍有 {pending_sends} 条消息、{timer_queue.qsize()} 个定时任务未处理")
+    await _cancel_background(list(background_tasks))
+
+def build_application() -> Application:
+    """创建处理命令的 Application：注册命令，后台任务随生命周期钩子启停，单进程和工作进程共用"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
+        .post_shutdown(close_stores)
     )
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+
+    # 添加命令，限流检查在所有命令之前执行
+    if FLOOD_PROTECTION:
+        application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    application.add_handler(CommandHandler("start", instrumented("start", start)))
+    application.add_handler(CommandHandler("help", instrumented("help", help_command)))
+    application.add_handler(CommandHandler("createnewgame", instrumented("createnewgame", create_game)))
+    application.add_handler(CommandHandler("stop", instrumented("stop", stop_game)))
+    application.add_handler(CommandHandler("join", instrumented("join", join_game)))
+    application.add_handler(CommandHandler("leave", instrumented("leave", leave_game)))
+    application.add_handler(CommandHandler("roll", instrumented("roll", roll_dice)))
+    application.add_handler(CommandHandler("adminstop", instrumented("adminstop", admin_stop)))
+    application.add_handler(CommandHandler("top", instrumented("top", top_command)))
+    application.add_handler(CommandHandler("mystats", instrumented("mystats", mystats_command)))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(ChatMemberHandler(chat_member_updated, ChatMemberHandler.ANY_CHAT_MEMBER))
+    return application
     
-    application.job_queue.run_once(
-        lambda ctx: asyncio.create_task(message_queue_sender(ctx)), 
-        when=0
-    )
+def run_application(application: Application) -> None:
+    """按 BOT_MODE 接收更新，直到收到退出信号"""
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES, allowed_updates=ALLOWED_UPDATES)
+
+
+def _shard_of(chat_id, count) -> int:
+    """chat_id 对应的工作进程序号；取模结果对负数 ID 也是非负的，且在重启前后保持不变"""
+    return chat_id % count
+
+class ShardWorker:
+    """前端进程中的一个工作进程：负责启动和重启进程，并由专门的线程把更新按顺序写进管道
+
+    更新先放进 pending，写入线程遇到工作进程退出时会等待重启后写入新管道，
+    因此工作进程崩溃期间到达的更新不会丢失，也不会打乱顺序。
+    """
+
+    def __init__(self, mp_context, index, count, budget):
+        self.mp_context = mp_context
+        self.index = index
+        self.count = count
+        self.budget = budget
+        self.pending = queue.SimpleQueue()
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self._writer = threading.Thread(target=self._write_loop, name=f"shard-writer-{index}", daemon=True)
+
+    def start(self) -> None:
+        reader, writer = self.mp_context.Pipe(duplex=False)
+        self.process = self.mp_context.Process(
+            target=run_worker, args=(self.index, self.count, reader, self.budget),
+            name=f"tod-worker-{self.index}", daemon=True
+        )
+        self.process.start()
+        reader.close()
+        self.conn = writer
+        if not self._writer.is_alive():
+            self._writer.start()
+
+    def restart_if_dead(self) -> None:
+        if self.process.is_alive():
+            return
+        self.restarts += 1
+        logging.error(f"工作进程 {self.index} 已退出（exitcode={self.process.exitcode}），第 {self.restarts} 次重启")
+        self.conn.close()
+        self.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            payload = self.pending.get()
+            while True:
+                conn = self.conn
+                try:
+                    conn.send_bytes(payload)
+                    break
+                except OSError:
+                    if payload == b'':  # 正在退出，工作进程已经不在了
+                        return
+                    # 等待 restart_if_dead 换上新管道后重试
+                    while self.conn is conn:
+                        time.sleep(0.05)
+            if payload == b'':
+                return
+
+    def submit(self, payload: bytes) -> None:
+        self.pending.put(payload)
+
+    def stop(self, timeout) -> None:
+        self.pending.put(b'')
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.error(f"工作进程 {self.index} 未能按时退出，强制结束")
+            self.process.terminate()
+
+async def _serve_worker(index, count, conn) -> None:
+    global game_store, stats_store, spill_store, shard
+    shard = (index, count)
+    game_store = _create_game_store()
+    # 战绩要在更改 WORKERS 后（群组分到别的进程）仍然可见，所有工作进程共用一个数据库；
+    # 写入是定期的小批量，等待写锁最多 30 秒，失败的变化留到下次重试
+    stats_store = StatsStore(STATS_DB_PATH, STATS_CACHE_SIZE)
+    spill_store = _create_spill_store()
+    restored = restore_games(owns=lambda chat_id: _shard_of(chat_id, count) == index)
+    if restored:
+        logging.warning(f"工作进程 {index} 已从存储中恢复 {restored} 个游戏")
+
+    application = build_application()
+    try:
+        async with application:
+            await application.start()
+            # 这里不经过 run_polling，post_init/post_stop/post_shutdown 不会被调用
+            await start_background_tasks(application)
+            while True:
+                try:
+                    payload = await asyncio.to_thread(conn.recv_bytes)
+                except EOFError:  # 前端进程已退出
+                    break
+                if not payload:
+                    break
+                update = Update.de_json(json.loads(payload), application.bot)
+                await application.update_queue.put(update)
+            await application.stop()
+            await stop_background_tasks(application)
+    finally:
+        game_store.close()
+        stats_store.close()
+        if spill_store is not None:
+            spill_store.close()
+
+def run_worker(index, count, conn, budget) -> None:
+    """工作进程入口：只处理分给自己的群组，拥有独立的游戏、计时器和发送队列"""
+    global send_budget
+    # Ctrl+C 会发给整个进程组，由前端通过管道通知工作进程退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    send_budget = budget
+    asyncio.run(_serve_worker(index, count, conn))
+
+def run_front() -> None:
+    """前端进程：接收更新，按 chat_id 转发给 WORKERS 个工作进程，并在工作进程退出时重启它"""
+    mp_context = multiprocessing.get_context("spawn")
+    budget = SharedTokenBucket(mp_context, MAX_MESSAGES_PER_SECOND, GLOBAL_BURST)
+    workers = [ShardWorker(mp_context, index, WORKERS, budget) for index in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        workers[_shard_of(chat_id, WORKERS)].submit(json.dumps(update.to_dict()).encode())
+
+    async def supervise_workers(context: CallbackContext) -> None:
+        for worker in workers:
+            worker.restart_if_dead()
+
+    async def stop_workers(application: Application) -> None:
+        for worker in workers:
+            # 工作进程退出前要先发完待发消息
+            await asyncio.to_thread(worker.stop, SHUTDOWN_DRAIN_TIMEOUT + 10)
+
+    builder = Application.builder().token(TOKEN).post_shutdown(stop_workers)
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, route_update))
+    application.job_queue.run_repeating(supervise_workers, interval=WORKER_CHECK_INTERVAL, first=WORKER_CHECK_INTERVAL)
+    run_application(application)
+
+
+def main():
+    if WORKERS > 1:
+        run_front()
+        return
+
+    global game_store, stats_store, spill_store
+    game_store = _create_game_store()
+    stats_store = StatsStore(STATS_DB_PATH, STATS_CACHE_SIZE)
+    spill_store = _create_spill_store()
+    restored = restore_games()
+    if restored:
+        logging.warning(f"已从存储中恢复 {restored} 个游戏")
 
-    application.run_polling()
+    run_application(build_application())
 
 if __name__ == '__main__':
     main()